@@ -1,73 +1,3218 @@
 from __future__ import annotations
 
+import base64
+import binascii
+import bisect
+import cProfile
+import hashlib
+import heapq
+import itertools
 import json
 import csv
+import gc
+import gzip
 import io
+import mimetypes
+import os
+import pstats
+import random
+import re
+import secrets
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import unicodedata
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import IO, Any, Dict, Iterable, Iterator, List, Tuple
 from uuid import uuid4
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows; fall back to in-process locks
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional; static assets are then offered gzip-compressed only
+    brotli = None
+
+try:
+    from gunicorn.app.base import BaseApplication as GunicornApplication
+except ImportError:  # optional; `serve` then uses the built-in prefork server
+    GunicornApplication = None
+
+try:
+    import waitress
+except ImportError:  # optional; only used where os.fork is missing (Windows)
+    waitress = None
+
+import click
+
 from flask import (
     Flask,
     abort,
+    before_render_template,
     flash,
+    g,
+    jsonify,
     make_response,
     redirect,
     render_template,
     request,
+    send_file,
+    send_from_directory,
     session,
+    stream_with_context,
+    template_rendered,
     url_for,
     Response,
 )
+from markupsafe import Markup
+from werkzeug.security import safe_join
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, run_simple
+
+BASE_DIR = Path(__file__).resolve().parent
+# SHOP_DATA_DIR points the app at another data directory (the benchmarks use
+# a generated one)
+DATA_DIR = Path(os.environ.get("SHOP_DATA_DIR", BASE_DIR / "data"))
+USERS_FILE = DATA_DIR / "users.json"
+SALES_FILE = DATA_DIR / "sales.json"
+PRODUCTS_FILE = DATA_DIR / "products.json"
+SALES_JOURNAL_FILE = DATA_DIR / "sales.journal.jsonl"
+SALES_SHARDS_DIR = DATA_DIR / "sales"
+DATABASE_FILE = DATA_DIR / "shop.db"
+IMAGES_DIR = DATA_DIR / "images"
+CARTS_FILE = DATA_DIR / "carts.db"
+EVENTS_FILE = DATA_DIR / "events.db"
+METRICS_FILE = DATA_DIR / "metrics.db"
+
+# "json" keeps everything in the data/*.json files; "sqlite" stores the same
+# records in DATABASE_FILE (see migrate_json_to_sqlite).
+STORAGE_BACKEND = os.environ.get("SHOP_STORAGE", "json")
+
+# "json" rewrites sales.json on every change; "journal" appends each change to
+# SALES_JOURNAL_FILE and folds it into sales.json once it grows past
+# SALES_JOURNAL_COMPACT_AT records; "monthly" keeps one file per month of
+# created_at in SALES_SHARDS_DIR and rewrites only the month a change touches.
+SALES_STORAGE = os.environ.get("SHOP_SALES_STORAGE", "json")
+SALES_JOURNAL_COMPACT_AT = int(os.environ.get("SHOP_SALES_JOURNAL_COMPACT_AT", "10000"))
+
+
+# ----- Metrics -----
+# Counters and latency histograms, rendered in the Prometheus text format by
+# /metrics. Each process counts in memory; a background thread copies its
+# numbers every METRICS_FLUSH_INTERVAL seconds to METRICS_FILE, a SQLite file
+# shared by the workers with one row per process, and /metrics adds up every
+# row (its own process's numbers live), so whichever worker answers reports
+# them all. Rows of workers that exited are kept, so the totals never drop.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_FLUSH_INTERVAL = 5.0
+METRICS_HELP = {
+    "shop_request_seconds": ("histogram", "Request latency by endpoint, method and status."),
+    "shop_template_seconds": ("histogram", "Jinja rendering time by template."),
+    "shop_storage_seconds": ("histogram", "Time spent reading or writing a data file."),
+    "shop_storage_bytes_total": ("counter", "Bytes parsed from or written to data files."),
+    "shop_section_seconds": ("histogram", "Time spent in instrumented sections such as report generation."),
+    "shop_json_cache_total": ("counter", "Parsed JSON cache lookups and evictions."),
+    "shop_fragment_cache_total": ("counter", "Rendered fragment cache lookups and evictions."),
+}
+_metrics_lock = threading.Lock()
+# (name, labels) -> cumulative bucket counts followed by sum and count
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_metrics_local = threading.local()
+# this process's row in METRICS_FILE, the JSON last written there, and
+# whether its flusher thread runs
+_metrics_process: Dict[str, Any] = {"id": secrets.token_hex(8), "written": None, "flusher": False}
+
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                entry[i] += 1
+        entry[-2] += seconds
+        entry[-1] += 1
+
+
+def count(name: str, value: float = 1, **labels: str) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def timed(name: str, **labels: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _metric_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    def escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    text = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+    return "{" + text + "}" if text else ""
+
+
+def _metrics_db() -> sqlite3.Connection:
+    conn = getattr(_metrics_local, "conn", None)
+    if conn is None:
+        METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(METRICS_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS processes (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        _metrics_local.conn = conn
+    return conn
+
+
+def _metrics_snapshot() -> Tuple[Dict[Any, List[float]], Dict[Any, float]]:
+    with _metrics_lock:
+        histograms = {key: list(entry) for key, entry in _histograms.items()}
+        counters = dict(_counters)
+    for result, value in cache_stats.items():
+        counters[("shop_json_cache_total", (("result", result),))] = value
+    for result, value in fragment_stats.items():
+        counters[("shop_fragment_cache_total", (("result", result),))] = value
+    return histograms, counters
+
+
+def flush_metrics() -> None:
+    """Write this process's numbers to its row in METRICS_FILE, if they changed."""
+    histograms, counters = _metrics_snapshot()
+    data = json.dumps(
+        {
+            "histograms": [[name, labels, entry] for (name, labels), entry in histograms.items()],
+            "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+        }
+    )
+    if data == _metrics_process["written"]:
+        return
+    _metrics_db().execute(
+        "INSERT INTO processes (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+        (_metrics_process["id"], data),
+    )
+    _metrics_process["written"] = data
+
+
+def start_metrics_flusher() -> None:
+    """Start this process's flusher thread, once."""
+    with _metrics_lock:
+        if _metrics_process["flusher"]:
+            return
+        _metrics_process["flusher"] = True
+
+    def run() -> None:
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                flush_metrics()
+            except sqlite3.Error:
+                # busy or unwritable: try again next round
+                pass
+
+    threading.Thread(target=run, name="metrics-flush", daemon=True).start()
+
+
+def _reset_process_metrics() -> None:
+    # a forked worker starts from zero under a row of its own, or every
+    # worker would report the numbers the parent gathered before forking
+    global _metrics_lock
+    _metrics_lock = threading.Lock()
+    _histograms.clear()
+    _counters.clear()
+    for stats in (cache_stats, fragment_stats):
+        for key in stats:
+            stats[key] = 0
+    _metrics_process.update(id=secrets.token_hex(8), written=None, flusher=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_process_metrics)
+
+
+def render_metrics() -> str:
+    """Every process's numbers added up, in the Prometheus text format."""
+    flush_metrics()
+    histograms: Dict[Any, List[float]] = {}
+    counters: Dict[Any, float] = {}
+    for (data,) in _metrics_db().execute("SELECT data FROM processes"):
+        data = json.loads(data)
+        for name, labels, entry in data["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(entry))
+            for i, value in enumerate(entry):
+                total[i] += value
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+    lines: List[str] = []
+    names = sorted({name for name, _ in histograms} | {name for name, _ in counters})
+    for name in names:
+        kind, help_text = METRICS_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), entry in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, cumulative in zip(LATENCY_BUCKETS, entry):
+                lines.append(f"{name}_bucket{_metric_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {entry[-1]}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {entry[-2]:.6f}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {entry[-1]}")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_metric_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+# ----- Request profiler -----
+# A request runs under cProfile when an admin asks for it (X-Profile: 1
+# header or ?profile=1) or when it is picked by SHOP_PROFILE_SAMPLE, the
+# share of all requests to profile (0 by default). Each profile is kept in
+# PROFILES_DIR as the raw .pstats file, loadable with the pstats module or
+# snakeviz, and a .json file with the request details and the top
+# PROFILE_TOP functions by cumulative time. Only one request per process is
+# profiled at a time; others asking meanwhile run unprofiled.
+PROFILES_DIR = DATA_DIR / "profiles"
+PROFILE_SAMPLE_RATE = float(os.environ.get("SHOP_PROFILE_SAMPLE", "0"))
+PROFILE_TOP = 40
+PROFILE_KEEP = 100
+_PROFILE_ID = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+_profile_lock = threading.Lock()
+
+
+def start_profile() -> cProfile.Profile | None:
+    """A running profiler, or None when another request is being profiled."""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except BaseException:
+        _profile_lock.release()
+        raise
+    return profiler
+
+
+def stop_profile(profiler: cProfile.Profile) -> None:
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+
+
+def _profile_function(key: Tuple[str, int, str]) -> str:
+    file_name, line, function = key
+    if file_name == "~":
+        # built-ins have no file
+        return function
+    try:
+        file_name = str(Path(file_name).relative_to(BASE_DIR))
+    except ValueError:
+        # library code: keep the path from the package on
+        file_name = file_name.rpartition("site-packages/")[2]
+    return f"{file_name}:{line}({function})"
+
+
+def save_profile(profiler: cProfile.Profile, meta: Dict[str, Any]) -> str:
+    """Write the .pstats and .json files for a finished profile; returns its id."""
+    PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{secrets.token_hex(4)}"
+    profiler.dump_stats(PROFILES_DIR / f"{profile_id}.pstats")
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+    summary = dict(
+        meta,
+        id=profile_id,
+        created_at=utc_now(),
+        total_calls=stats.total_calls,
+        top=[
+            {
+                "function": _profile_function(key),
+                "calls": calls,
+                "primitive_calls": primitive,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            }
+            for key, (primitive, calls, tottime, cumtime, _) in rows
+        ],
+    )
+    # not save_json: profiles must not add per-file series to the storage
+    # metrics or entries to the data cache
+    with _atomic_open(PROFILES_DIR / f"{profile_id}.json") as file:
+        json.dump(summary, file, indent=2, ensure_ascii=False)
+    _prune_profiles()
+    return profile_id
+
+
+def _read_profile(path: Path) -> Dict[str, Any] | None:
+    try:
+        with path.open("r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        # pruned by another request meanwhile
+        return None
+
+
+def _prune_profiles() -> None:
+    for old in sorted(PROFILES_DIR.glob("*.json"), reverse=True)[PROFILE_KEEP:]:
+        old.unlink(missing_ok=True)
+        old.with_suffix(".pstats").unlink(missing_ok=True)
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Stored profiles, newest first, without their function tables."""
+    if not PROFILES_DIR.exists():
+        return []
+    profiles = []
+    for path in sorted(PROFILES_DIR.glob("*.json"), reverse=True):
+        try:
+            data = _read_profile(path)
+        except ValueError:
+            continue
+        if data is None:
+            continue
+        profiles.append({k: v for k, v in data.items() if k != "top"})
+    return profiles
+
+
+def load_profile(profile_id: str) -> Dict[str, Any] | None:
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    return _read_profile(PROFILES_DIR / f"{profile_id}.json")
+
+
+# ----- Parsed JSON cache -----
+# Payloads are kept in LRU order together with the (mtime_ns, size) stamp of
+# the file they came from, so edits made by another process are picked up on
+# the next read while unchanged files are never re-parsed. The cap is measured
+# by on-disk JSON size, which is roughly proportional to the parsed objects.
+DATA_CACHE_MAX_BYTES = int(os.environ.get("SHOP_DATA_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+_data_cache: "OrderedDict[Path, Tuple[Tuple[int, int], Dict[str, Any]]]" = OrderedDict()
+_data_cache_bytes = 0
+_data_cache_lock = threading.Lock()
+cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _file_stamp(file_path: Path) -> Tuple[int, int] | None:
+    try:
+        st = file_path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _cache_store(file_path: Path, stamp: Tuple[int, int], payload: Dict[str, Any]) -> None:
+    """Insert a payload and evict least recently used entries over the cap. Caller holds the lock."""
+    global _data_cache_bytes
+    previous = _data_cache.pop(file_path, None)
+    if previous is not None:
+        _data_cache_bytes -= previous[0][1]
+    if stamp[1] > DATA_CACHE_MAX_BYTES:
+        return
+    _data_cache[file_path] = (stamp, payload)
+    _data_cache_bytes += stamp[1]
+    while _data_cache_bytes > DATA_CACHE_MAX_BYTES:
+        _, (old_stamp, _) = _data_cache.popitem(last=False)
+        _data_cache_bytes -= old_stamp[1]
+        cache_stats["evictions"] += 1
+
+
+def clear_data_cache() -> None:
+    global _data_cache_bytes
+    with _data_cache_lock:
+        _data_cache.clear()
+        _data_cache_bytes = 0
+
+
+def load_json(file_path: Path) -> Dict[str, Any]:
+    """Return the parsed payload of ``file_path``; the result is shared and must not be mutated."""
+    start = time.perf_counter()
+    stamp = _file_stamp(file_path)
+    if stamp is None:
+        return {}
+    with _data_cache_lock:
+        entry = _data_cache.get(file_path)
+        if entry is not None and entry[0] == stamp:
+            _data_cache.move_to_end(file_path)
+            cache_stats["hits"] += 1
+            hit = entry[1]
+        else:
+            hit = None
+            cache_stats["misses"] += 1
+    if hit is not None:
+        observe("shop_storage_seconds", time.perf_counter() - start, file=file_path.name, op="read", cache="hit")
+        return hit
+    with file_path.open("r", encoding="utf-8") as file:
+        payload = json.load(file)
+    with _data_cache_lock:
+        _cache_store(file_path, stamp, payload)
+    observe("shop_storage_seconds", time.perf_counter() - start, file=file_path.name, op="read", cache="miss")
+    count("shop_storage_bytes_total", stamp[1], file=file_path.name, op="read")
+    return payload
+
+
+@contextmanager
+def _atomic_open(file_path: Path, mode: str = "w") -> Iterator[IO[Any]]:
+    """Open a temp file next to ``file_path`` and rename it over the target on success.
+
+    Readers in other workers see either the old or the new file, never a
+    partial one.
+    """
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=None if "b" in mode else "utf-8") as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp creates the file 0600; keep the permissions of the file we replace
+        try:
+            os.chmod(tmp_name, file_path.stat().st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, file_path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def save_json(file_path: Path, payload: Dict[str, Any]) -> None:
+    with timed("shop_storage_seconds", file=file_path.name, op="write", cache="none"):
+        with _atomic_open(file_path) as file:
+            json.dump(payload, file, indent=2, ensure_ascii=False)
+    # what we just wrote is the freshest copy, keep it instead of re-parsing
+    stamp = _file_stamp(file_path)
+    if stamp is not None:
+        count("shop_storage_bytes_total", stamp[1], file=file_path.name, op="write")
+    with _data_cache_lock:
+        if stamp is None:
+            _data_cache.pop(file_path, None)
+        else:
+            _cache_store(file_path, stamp, payload)
+
+
+# ----- File locks -----
+# One lock per data file, held across a read-modify-write so concurrent
+# workers cannot lose each other's updates. Locks are reentrant within a
+# thread and backed by flock() on a sidecar ".lock" file across processes.
+class _FileLock:
+    def __init__(self, file_path: Path) -> None:
+        self.lock_path = file_path.with_name(f".{file_path.name}.lock")
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.handle = None
+
+    def __enter__(self) -> "_FileLock":
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            try:
+                self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+                self.handle = self.lock_path.open("a")
+                fcntl.flock(self.handle, fcntl.LOCK_EX)
+            except BaseException:
+                if self.handle is not None:
+                    self.handle.close()
+                    self.handle = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.depth -= 1
+        if self.depth == 0 and self.handle is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+        self.thread_lock.release()
+
+
+_file_locks: Dict[Path, _FileLock] = {}
+_file_locks_guard = threading.Lock()
+
+
+def _file_lock(file_path: Path) -> _FileLock:
+    with _file_locks_guard:
+        lock = _file_locks.get(file_path)
+        if lock is None:
+            lock = _file_locks[file_path] = _FileLock(file_path)
+        return lock
+
+
+def _copy_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # cached payloads are shared between requests; routes mutate records in
+    # place, so hand out per-record copies
+    return [dict(record) for record in records]
+
+
+def get_users() -> List[Dict[str, Any]]:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_select("users")
+    data = load_json(USERS_FILE)
+    return _copy_records(data.get("users", []))
+
+
+def _shared_sales() -> Iterable[Dict[str, Any]]:
+    # the cached records of the JSON sales modes, not copied: only copy the
+    # ones handed out
+    if SALES_STORAGE == "journal":
+        return _journaled_sales().values()
+    if SALES_STORAGE == "monthly":
+        return (sale for name in _shard_names() for sale in _shard_sales(name))
+    return load_json(SALES_FILE).get("sales", [])
+
+
+def get_sales() -> List[Dict[str, Any]]:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_select("sales")
+    return _copy_records(list(_shared_sales()))
+
+
+def get_products() -> List[Dict[str, Any]]:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_select("products")
+    data = load_json(PRODUCTS_FILE)
+    return _copy_records(data.get("products", []))
+
+
+def get_product(product_id: str) -> Dict[str, Any] | None:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get("products", "id", product_id)
+    # scan the cached list and copy only the match, not the whole catalog
+    return next((dict(p) for p in load_json(PRODUCTS_FILE).get("products", []) if p.get("id") == product_id), None)
+
+
+def get_products_by_id(product_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up several products at once; unknown ids are left out."""
+    wanted = set(product_ids)
+    if STORAGE_BACKEND == "sqlite":
+        if not wanted:
+            return {}
+        rows = _db().execute(
+            f"SELECT doc FROM products WHERE id IN ({', '.join('?' * len(wanted))})", tuple(wanted)
+        )
+        products = [json.loads(row[0]) for row in rows]
+    else:
+        products = [dict(p) for p in load_json(PRODUCTS_FILE).get("products", []) if p.get("id") in wanted]
+    return {p["id"]: p for p in products}
+
+
+def get_sale(sale_id: str) -> Dict[str, Any] | None:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get("sales", "id", sale_id)
+    if SALES_STORAGE == "journal":
+        sale = _journaled_sales().get(sale_id)
+        return dict(sale) if sale is not None else None
+    if SALES_STORAGE == "monthly":
+        found = _find_sharded_sale(sale_id)
+        return dict(found[1]) if found is not None else None
+    return next((dict(s) for s in _shared_sales() if s.get("id") == sale_id), None)
+
+
+def get_sales_by_id(sale_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up several sales at once; unknown ids are left out."""
+    wanted = set(sale_ids)
+    if STORAGE_BACKEND == "sqlite":
+        if not wanted:
+            return {}
+        rows = _db().execute(f"SELECT doc FROM sales WHERE id IN ({', '.join('?' * len(wanted))})", tuple(wanted))
+        sales = [json.loads(row[0]) for row in rows]
+    elif SALES_STORAGE == "journal":
+        journaled = _journaled_sales()
+        sales = [dict(journaled[sale_id]) for sale_id in wanted if sale_id in journaled]
+    else:
+        sales = [dict(s) for s in _shared_sales() if s.get("id") in wanted]
+    return {s["id"]: s for s in sales}
+
+
+def persist_users(users: List[Dict[str, Any]]) -> None:
+    if STORAGE_BACKEND == "sqlite":
+        _db_replace_all("users", users)
+        return
+    save_json(USERS_FILE, {"users": users})
+
+
+def persist_products(products: List[Dict[str, Any]]) -> None:
+    if STORAGE_BACKEND == "sqlite":
+        _db_replace_all("products", products)
+        invalidate_fragments("products")
+        return
+    # every rewrite bumps the catalog version (see catalog_version)
+    version = int(load_json(PRODUCTS_FILE).get("version", 0)) + 1
+    save_json(PRODUCTS_FILE, {"version": version, "products": products})
+    invalidate_fragments("products")
+
+
+def catalog_version() -> int:
+    """Counter bumped by every product change; used for ETags and cache keys."""
+    if STORAGE_BACKEND == "sqlite":
+        row = _db().execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()
+        return int(row[0]) if row else 0
+    return int(load_json(PRODUCTS_FILE).get("version", 0))
+
+
+def add_user(user: Dict[str, Any]) -> None:
+    if STORAGE_BACKEND == "sqlite":
+        _db_upsert("users", [user])
+        return
+    with _file_lock(USERS_FILE):
+        users = get_users()
+        users.append(user)
+        persist_users(users)
+
+
+# JSON products and sales carry a ``seq`` giving their insertion order (the
+# SQLite tables have a column for it), so a listing cursor can point at a
+# position that survives the record being deleted
+_seq_lock = threading.Lock()
+_seq_last = {"value": 0}
+
+
+def new_seq() -> int:
+    """``seq`` for a new record: nanoseconds since the epoch, strictly increasing in this process."""
+    with _seq_lock:
+        _seq_last["value"] = max(time.time_ns(), _seq_last["value"] + 1)
+        return _seq_last["value"]
+
+
+def number_products() -> int:
+    """Give JSON products stored before ``seq`` existed their list position; returns how many."""
+    if STORAGE_BACKEND == "sqlite":
+        return 0
+    with write_transaction(PRODUCTS_FILE):
+        if all("seq" in p for p in load_json(PRODUCTS_FILE).get("products", [])):
+            return 0
+        products = get_products()
+        missing = 0
+        for position, prod in enumerate(products, start=1):
+            if "seq" not in prod:
+                prod["seq"] = position
+                missing += 1
+        persist_products(products)
+        return missing
+
+
+def save_products(changed: List[Dict[str, Any]], event: str = "update") -> None:
+    """Insert or replace products, matched by id, with a single write.
+
+    The change is published on the change feed as ``event`` ("create",
+    "update" or "stock").
+    """
+    with write_transaction(PRODUCTS_FILE):
+        before = catalog_version()
+        if STORAGE_BACKEND == "sqlite":
+            _db_upsert("products", changed)
+        else:
+            pending = {p["id"]: p for p in changed}
+            products = [pending.pop(p.get("id"), p) for p in get_products()]
+            for prod in pending.values():
+                prod.setdefault("seq", new_seq())
+            products.extend(pending.values())
+            persist_products(products)
+        _note_products_change(before, [p["id"] for p in changed], changed)
+        publish_events([(event, _product_event(event, p)) for p in changed])
+
+
+def save_product(product: Dict[str, Any], event: str = "update") -> None:
+    save_products([product], event)
+
+
+def adjust_products(
+    product_ids: Iterable[str], price: float | None = None, stock_delta: int | None = None
+) -> Tuple[int, List[str]]:
+    """Set the price and/or shift the stock of several products as one all-or-nothing write.
+
+    Returns how many products were found and the names of those whose stock
+    would drop below zero (nothing is changed then). Untracked stock is left
+    as it is.
+    """
+    with write_transaction(PRODUCTS_FILE):
+        found = get_products_by_id(product_ids)
+        changed = []
+        for p in found.values():
+            if price is not None:
+                p["price"] = price
+            if stock_delta is not None and _has_stock(p):
+                p["stock"] += stock_delta
+            changed.append(p)
+        short = [p.get("name") for p in changed if _has_stock(p) and p["stock"] < 0]
+        if changed and not short:
+            save_products(changed, event="update" if price is not None else "stock")
+    return len(found), short
+
+
+def delete_products(product_ids: Iterable[str]) -> int:
+    """Remove several products with a single write; returns how many existed."""
+    wanted = set(product_ids)
+    with write_transaction(PRODUCTS_FILE):
+        before = catalog_version()
+        if STORAGE_BACKEND == "sqlite":
+            removed = list(get_products_by_id(wanted))
+            if removed:
+                _db_delete("products", removed)
+        else:
+            products = get_products()
+            removed = [p["id"] for p in products if p.get("id") in wanted]
+            if removed:
+                persist_products([p for p in products if p.get("id") not in wanted])
+        if removed:
+            _note_products_change(before, removed, [])
+            publish_events([("delete", {"id": pid}) for pid in removed])
+        return len(removed)
+
+
+def delete_product(product_id: str) -> bool:
+    """Remove a product; returns False when no product has that id."""
+    return delete_products([product_id]) > 0
+
+
+def persist_sales(sales: List[Dict[str, Any]]) -> None:
+    invalidate_fragments("sales")
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction():
+            _db_replace_all("sales", sales)
+            rebuild_sales_aggregates()
+        return
+    if SALES_STORAGE == "journal":
+        with _file_lock(SALES_FILE), _journal_lock:
+            _write_sales_snapshot(sales)
+        return
+    if SALES_STORAGE == "monthly":
+        with _file_lock(SALES_FILE):
+            shards: Dict[str, List[Dict[str, Any]]] = {}
+            for sale in sales:
+                shards.setdefault(_shard_of(sale), []).append(sale)
+            for name in _shard_names():
+                if name not in shards:
+                    _write_shard(name, [])
+            for name, shard in shards.items():
+                if shard != _shard_sales(name):
+                    _write_shard(name, shard)
+        return
+    save_json(SALES_FILE, _sales_payload(sales))
+
+
+def _sales_payload(sales: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # everything written by this code already has the current record shape
+    return {"schema_version": SCHEMA_VERSION, "sales": sales}
+
+
+# ----- Monthly sales shards -----
+# In monthly mode every sale lives in SALES_SHARDS_DIR/<YYYY-MM>.json for the
+# UTC month of its created_at (sales from before timestamps existed go to
+# undated.json). A new sale only rewrites the current month, past months are
+# left alone unless one of their sales is edited or deleted, and date-range
+# reads open just the months they cover. Writers hold the SALES_FILE lock, as
+# in the other JSON modes.
+UNDATED_SHARD = "undated"
+_SHARD_FILE = re.compile(r"^(\d{4}-\d{2}|undated)\.json$")
+_MONTH_PREFIX = re.compile(r"^\d{4}-\d{2}")
+
+
+def utc_now() -> str:
+    """Timestamp stored in a sale's created_at, e.g. 2025-03-14T09:26:53Z."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def date_bounds(date_from: str | None, date_to: str | None) -> Tuple[str | None, str | None]:
+    """created_at bounds for an inclusive YYYY-MM-DD range: (from, day after ``date_to``).
+
+    Missing or malformed dates leave that side open.
+    """
+    lower = upper = None
+    try:
+        if date_from:
+            lower = datetime.strptime(date_from, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+    try:
+        if date_to:
+            upper = (datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+    return lower, upper
+
+
+def _in_date_range(sale: Dict[str, Any], lower: str | None, upper: str | None) -> bool:
+    if lower is None and upper is None:
+        return True
+    created = sale.get("created_at")
+    if not isinstance(created, str):
+        return False
+    return (lower is None or created >= lower) and (upper is None or created < upper)
+
+
+def _shard_of(sale: Dict[str, Any]) -> str:
+    created = sale.get("created_at")
+    if isinstance(created, str) and _MONTH_PREFIX.match(created):
+        return created[:7]
+    return UNDATED_SHARD
+
+
+def _shard_path(name: str) -> Path:
+    return SALES_SHARDS_DIR / f"{name}.json"
+
+
+def _shard_names(lower: str | None = None, upper: str | None = None) -> List[str]:
+    """Shards in storage order (undated first, then by month), limited to a created_at range."""
+    if not SALES_SHARDS_DIR.is_dir():
+        return []
+    names = sorted(p.name[: -len(".json")] for p in SALES_SHARDS_DIR.iterdir() if _SHARD_FILE.match(p.name))
+    names.sort(key=lambda name: name != UNDATED_SHARD)
+    if lower is None and upper is None:
+        return names
+    return [
+        name
+        for name in names
+        if name != UNDATED_SHARD and (lower is None or name >= lower[:7]) and (upper is None or name <= upper[:7])
+    ]
+
+
+def _shard_sales(name: str) -> List[Dict[str, Any]]:
+    """Sales of one shard; the list is the cached one and must not be mutated."""
+    return load_json(_shard_path(name)).get("sales", [])
+
+
+def _write_shard(name: str, sales: List[Dict[str, Any]]) -> None:
+    """Replace a shard, or remove it when ``sales`` is empty. Caller holds the SALES_FILE lock."""
+    if sales:
+        save_json(_shard_path(name), {"schema_version": SCHEMA_VERSION, "month": name, "sales": sales})
+    else:
+        _shard_path(name).unlink(missing_ok=True)
+
+
+def _shards_stamp() -> Tuple[Any, ...]:
+    return tuple((name, _file_stamp(_shard_path(name))) for name in _shard_names())
+
+
+def _find_sharded_sale(sale_id: str) -> Tuple[str, Dict[str, Any]] | None:
+    # newest months first: recent sales are the ones usually looked up
+    for name in reversed(_shard_names()):
+        for sale in _shard_sales(name):
+            if sale.get("id") == sale_id:
+                return name, sale
+    return None
+
+
+def shard_sales() -> int:
+    """Move sales.json (and any journal) into monthly shards. Returns the sales moved.
+
+    Runs from migrate_data in monthly mode; the old file is kept renamed to
+    sales.json.sharded.
+    """
+    with _file_lock(SALES_FILE), _journal_lock:
+        if not SALES_FILE.exists() and not SALES_JOURNAL_FILE.exists():
+            return 0
+        sales = list(_journaled_sales().values())
+        existing = {sale.get("id") for name in _shard_names() for sale in _shard_sales(name)}
+        moved = [sale for sale in sales if sale.get("id") not in existing]
+        # shards are stamped with SCHEMA_VERSION, so bring the moved sales up to it first
+        version = int(load_json(SALES_FILE).get("schema_version", 0)) if SALES_FILE.exists() else SCHEMA_VERSION
+        for target, upgrade in SCHEMA_MIGRATIONS:
+            if target > version:
+                moved = [upgrade(sale) for sale in moved]
+        shards: Dict[str, List[Dict[str, Any]]] = {}
+        for sale in moved:
+            shards.setdefault(_shard_of(sale), []).append(sale)
+        for name, shard in shards.items():
+            _write_shard(name, sorted(list(_shard_sales(name)) + shard, key=_seq_key))
+        if SALES_FILE.exists():
+            os.replace(SALES_FILE, SALES_FILE.with_name(SALES_FILE.name + ".sharded"))
+        SALES_JOURNAL_FILE.unlink(missing_ok=True)
+        return len(moved)
+
+
+# ----- Sales journal -----
+# In journal mode the current sales are the sales.json snapshot plus every
+# record appended to the journal since, replayed in order. The replayed state
+# is kept in memory (keyed by sale id, in insertion order) and only rebuilt
+# when either file changes behind our back. Writers hold the SALES_FILE lock
+# for both files; replaying is idempotent, so a reader racing a compaction
+# still ends up with the right state.
+_journal_lock = threading.RLock()
+_journal_state: Dict[str, Any] = {"stamp": None, "sales": {}, "records": 0}
+
+
+def _journal_stamp() -> Tuple[Any, Any]:
+    return (_file_stamp(SALES_FILE), _file_stamp(SALES_JOURNAL_FILE))
+
+
+def _apply_journal_record(sales: Dict[str, Dict[str, Any]], record: Dict[str, Any]) -> None:
+    if record.get("op") == "delete":
+        sales.pop(record.get("id"), None)
+    else:
+        sale = record.get("sale") or {}
+        sales[sale.get("id")] = sale
+
+
+def _journaled_sales() -> Dict[str, Dict[str, Any]]:
+    with _journal_lock:
+        stamp = _journal_stamp()
+        if _journal_state["stamp"] == stamp:
+            return _journal_state["sales"]
+        sales = {sale["id"]: dict(sale) for sale in load_json(SALES_FILE).get("sales", [])}
+        records = 0
+        if SALES_JOURNAL_FILE.exists():
+            with SALES_JOURNAL_FILE.open("r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a torn last line from an interrupted append
+                        continue
+                    _apply_journal_record(sales, record)
+                    records += 1
+        _journal_state.update({"stamp": stamp, "sales": sales, "records": records})
+        return sales
+
+
+def _append_sales_journal(records: List[Dict[str, Any]]) -> None:
+    with _file_lock(SALES_FILE), _journal_lock:
+        sales = _journaled_sales()
+        SALES_JOURNAL_FILE.parent.mkdir(parents=True, exist_ok=True)
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        with timed("shop_storage_seconds", file=SALES_JOURNAL_FILE.name, op="append", cache="none"):
+            with SALES_JOURNAL_FILE.open("a", encoding="utf-8") as file:
+                file.write(data)
+        count("shop_storage_bytes_total", len(data.encode("utf-8")), file=SALES_JOURNAL_FILE.name, op="append")
+        for record in records:
+            _apply_journal_record(sales, record)
+        _journal_state["stamp"] = _journal_stamp()
+        _journal_state["records"] += len(records)
+        if _journal_state["records"] >= SALES_JOURNAL_COMPACT_AT:
+            threading.Thread(target=compact_sales_journal, daemon=True).start()
+
+
+def _write_sales_snapshot(sales: List[Dict[str, Any]]) -> None:
+    """Write ``sales`` as the new snapshot and empty the journal. Caller holds the lock."""
+    save_json(SALES_FILE, _sales_payload(sales))
+    if SALES_JOURNAL_FILE.exists():
+        SALES_JOURNAL_FILE.unlink()
+    _journal_state.update(
+        {"stamp": _journal_stamp(), "sales": {sale["id"]: sale for sale in sales}, "records": 0}
+    )
+
+
+def compact_sales_journal() -> int:
+    """Fold the journal into sales.json. Returns the number of records folded."""
+    with _file_lock(SALES_FILE), _journal_lock:
+        sales = _journaled_sales()
+        folded = _journal_state["records"]
+        if folded:
+            before = _sales_stamp()
+            _write_sales_snapshot(_copy_records(list(sales.values())))
+            # same sales, new files: keep the aggregates
+            _note_sales_change(before, [], [])
+        return folded
+
+
+def add_sales(new_sales: List[Dict[str, Any]]) -> None:
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction():
+            _db_upsert("sales", new_sales)
+            _db_adjust_aggregates([], new_sales)
+        return
+    with _file_lock(SALES_FILE):
+        before = _sales_stamp()
+        for sale in new_sales:
+            sale.setdefault("seq", new_seq())
+        if SALES_STORAGE == "journal":
+            _append_sales_journal([{"op": "add", "sale": sale} for sale in new_sales])
+        elif SALES_STORAGE == "monthly":
+            shards: Dict[str, List[Dict[str, Any]]] = {}
+            for sale in new_sales:
+                shards.setdefault(_shard_of(sale), []).append(sale)
+            for name, added in shards.items():
+                _write_shard(name, _shard_sales(name) + added)
+        else:
+            sales = get_sales()
+            sales.extend(new_sales)
+            persist_sales(sales)
+        _note_sales_change(before, [], new_sales)
+
+
+def add_sale(sale: Dict[str, Any]) -> None:
+    add_sales([sale])
+
+
+def update_sales(changed: List[Dict[str, Any]]) -> None:
+    """Replace sales, matched by id, with a single write."""
+    pending = {sale["id"]: sale for sale in changed}
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction():
+            previous = list(get_sales_by_id(pending).values())
+            _db_upsert("sales", changed)
+            _db_adjust_aggregates(previous, changed)
+        return
+    with _file_lock(SALES_FILE):
+        before = _sales_stamp()
+        if SALES_STORAGE == "journal":
+            previous = list(get_sales_by_id(pending).values())
+            _append_sales_journal([{"op": "update", "sale": sale} for sale in changed])
+        elif SALES_STORAGE == "monthly":
+            previous = []
+            shards: Dict[str, List[Dict[str, Any]]] = {}
+            # sales that stay in their month keep their place; the others are
+            # appended to the shard of their new month
+            moved = dict(pending)
+            for name in _shard_names():
+                shard = _shard_sales(name)
+                if not any(item["id"] in pending for item in shard):
+                    continue
+                shards[name] = []
+                for item in shard:
+                    sale = pending.get(item["id"])
+                    if sale is None:
+                        shards[name].append(item)
+                        continue
+                    previous.append(item)
+                    if _shard_of(sale) == name:
+                        shards[name].append(moved.pop(sale["id"]))
+            for sale in moved.values():
+                name = _shard_of(sale)
+                if name not in shards:
+                    shards[name] = list(_shard_sales(name))
+                shards[name].append(sale)
+                # shards stay in seq order for the listing cursors
+                shards[name].sort(key=_seq_key)
+            for name, shard in shards.items():
+                _write_shard(name, shard)
+        else:
+            sales = get_sales()
+            previous = [item for item in sales if item["id"] in pending]
+            persist_sales([pending.get(item["id"], item) for item in sales])
+        _note_sales_change(before, previous, changed)
+
+
+def update_sale(sale: Dict[str, Any]) -> None:
+    update_sales([sale])
+
+
+def edit_sales(sale_ids: Iterable[str], fields: Dict[str, Any]) -> int:
+    """Set ``fields`` on several sales with a single write; returns how many were found."""
+    with write_transaction(SALES_FILE):
+        found = get_sales_by_id(sale_ids)
+        if found:
+            update_sales([dict(sale, **fields) for sale in found.values()])
+    return len(found)
+
+
+def delete_sales(sale_ids: Iterable[str]) -> int:
+    """Remove several sales with a single write; returns how many existed."""
+    wanted = set(sale_ids)
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction():
+            previous = list(get_sales_by_id(wanted).values())
+            if previous:
+                _db_delete("sales", wanted)
+                _db_adjust_aggregates(previous, [])
+        return len(previous)
+    with _file_lock(SALES_FILE):
+        before = _sales_stamp()
+        if SALES_STORAGE == "journal":
+            previous = list(get_sales_by_id(wanted).values())
+            if previous:
+                _append_sales_journal([{"op": "delete", "id": sale["id"]} for sale in previous])
+        elif SALES_STORAGE == "monthly":
+            previous = []
+            for name in _shard_names():
+                shard = _shard_sales(name)
+                removed = [item for item in shard if item["id"] in wanted]
+                if removed:
+                    previous.extend(removed)
+                    _write_shard(name, [item for item in shard if item["id"] not in wanted])
+        else:
+            sales = get_sales()
+            previous = [sale for sale in sales if sale["id"] in wanted]
+            if previous:
+                persist_sales([sale for sale in sales if sale["id"] not in wanted])
+        if previous:
+            _note_sales_change(before, previous, [])
+        return len(previous)
+
+
+def delete_sale(sale_id: str) -> bool:
+    """Remove a sale; returns False when no sale has that id."""
+    return delete_sales([sale_id]) > 0
+
+
+# ----- SQLite backend -----
+# Each table keeps the full record as JSON in ``doc`` next to the columns we
+# look records up by; ``seq`` preserves insertion order so listings come out
+# the same as with the JSON files.
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    sku TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_sku ON products (sku);
+CREATE TABLE IF NOT EXISTS sales (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    product_id TEXT,
+    seller TEXT,
+    created_at TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sales_product_id ON sales (product_id);
+CREATE INDEX IF NOT EXISTS sales_seller ON sales (seller);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0);
+CREATE TRIGGER IF NOT EXISTS products_version_insert AFTER INSERT ON products BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+END;
+CREATE TRIGGER IF NOT EXISTS products_version_update AFTER UPDATE ON products BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+END;
+CREATE TRIGGER IF NOT EXISTS products_version_delete AFTER DELETE ON products BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+END;
+INSERT OR IGNORE INTO meta (key, value) VALUES ('sales_version', 0);
+CREATE TRIGGER IF NOT EXISTS sales_version_insert AFTER INSERT ON sales BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'sales_version';
+END;
+CREATE TRIGGER IF NOT EXISTS sales_version_update AFTER UPDATE ON sales BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'sales_version';
+END;
+CREATE TRIGGER IF NOT EXISTS sales_version_delete AFTER DELETE ON sales BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'sales_version';
+END;
+CREATE TABLE IF NOT EXISTS sales_aggregates (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    units REAL NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, key)
+);
+"""
+
+# table -> (key column, other indexed columns)
+_DB_COLUMNS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "users": ("username", ()),
+    "products": ("id", ("sku",)),
+    "sales": ("id", ("product_id", "seller", "created_at")),
+}
+
+_db_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    """Per-thread connection to DATABASE_FILE, created with the schema on first use."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        DATABASE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_DB_SCHEMA)
+        _db_local.conn = conn
+        # databases created before sales had timestamps lack the column
+        if "created_at" not in {row[1] for row in conn.execute("PRAGMA table_info(sales)")}:
+            with _db_transaction():
+                conn.execute("ALTER TABLE sales ADD COLUMN created_at TEXT")
+                conn.execute("UPDATE sales SET created_at = json_extract(doc, '$.created_at')")
+        conn.execute("CREATE INDEX IF NOT EXISTS sales_created_at ON sales (created_at)")
+        # one index per sortable listing field, on the expression _db_page sorts by
+        for table, sorts in (("products", PRODUCT_SORTS), ("sales", SALE_SORTS)):
+            for name, spec in sorts.items():
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_by_{name} ON {table} ({_db_sort_expr(*spec)}, id)")
+        # databases created before sales_aggregates existed start with it empty
+        if conn.execute("SELECT 1 FROM sales LIMIT 1").fetchone() and not conn.execute(
+            "SELECT 1 FROM sales_aggregates LIMIT 1"
+        ).fetchone():
+            rebuild_sales_aggregates()
+    return conn
+
+
+def _db_select(table: str) -> List[Dict[str, Any]]:
+    rows = _db().execute(f"SELECT doc FROM {table} ORDER BY seq")
+    return [json.loads(row[0]) for row in rows]
+
+
+def _db_get(table: str, column: str, value: Any) -> Dict[str, Any] | None:
+    row = _db().execute(f"SELECT doc FROM {table} WHERE {column} = ?", (value,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _db_row(table: str, record: Dict[str, Any]) -> Tuple[Any, ...]:
+    key, indexed = _DB_COLUMNS[table]
+    return (record.get(key), *(record.get(c) for c in indexed), json.dumps(record, ensure_ascii=False))
+
+
+@contextmanager
+def _db_transaction() -> Iterator[sqlite3.Connection]:
+    """Run the block in one write transaction; nested blocks join the outer one."""
+    conn = _db()
+    if conn.in_transaction:
+        yield conn
+        return
+    # IMMEDIATE takes the write lock up front, so reads made inside the block
+    # cannot be invalidated by another writer before we commit
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _db_upsert(table: str, records: List[Dict[str, Any]]) -> None:
+    key, indexed = _DB_COLUMNS[table]
+    columns = (key, *indexed, "doc")
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT({key}) DO UPDATE SET {updates}"
+    )
+    with _db_transaction() as conn:
+        conn.executemany(sql, [_db_row(table, r) for r in records])
+
+
+def _db_delete(table: str, key_values: Iterable[Any]) -> int:
+    key, _ = _DB_COLUMNS[table]
+    with _db_transaction() as conn:
+        cur = conn.executemany(f"DELETE FROM {table} WHERE {key} = ?", [(v,) for v in key_values])
+    return cur.rowcount
+
+
+def _db_replace_all(table: str, records: List[Dict[str, Any]]) -> None:
+    with _db_transaction() as conn:
+        conn.execute(f"DELETE FROM {table}")
+        _db_upsert(table, records)
+
+
+@contextmanager
+def write_transaction(*files: Path) -> Iterator[None]:
+    """Group reads and writes that must be applied together (read-validate-write).
+
+    With the JSON backend only the given data files are locked, always in the
+    same order so two transactions cannot deadlock.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction():
+            yield
+        return
+    with ExitStack() as stack:
+        for file_path in sorted(set(files)):
+            stack.enter_context(_file_lock(file_path))
+        yield
+
+
+def migrate_json_to_sqlite() -> Dict[str, int]:
+    """Copy users, products and sales from the JSON files into DATABASE_FILE.
+
+    Records are upserted by key, so running it twice is harmless. Pending
+    sales journal records are included.
+    """
+    counts = {}
+    sources = {
+        "users": load_json(USERS_FILE).get("users", []),
+        "products": load_json(PRODUCTS_FILE).get("products", []),
+        "sales": (
+            [sale for name in _shard_names() for sale in _shard_sales(name)]
+            if SALES_STORAGE == "monthly"
+            else list(_journaled_sales().values())
+        ),
+    }
+    with _db_transaction():
+        for table, records in sources.items():
+            _db_upsert(table, records)
+            counts[table] = len(records)
+        # sales copied from older JSON files still need their migrations
+        json_version = int(load_json(SALES_FILE).get("schema_version", 0))
+        if json_version < schema_version():
+            _db().execute(f"PRAGMA user_version = {json_version}")
+        rebuild_sales_aggregates()
+    migrate_data()
+    return counts
+
+
+# ----- Sales aggregates -----
+# Units, revenue and number of sales per product, seller and customer, kept up
+# to date by every sales write instead of being recomputed from all sales.
+# SQLite keeps them in the sales_aggregates table, changed in the same
+# transaction as the sales. The JSON backends keep them in memory tagged with
+# the sales stamp they match; a write made by another process changes the
+# stamp and the next read rebuilds them once.
+AGGREGATE_DIMENSIONS = ("product", "seller", "customer")
+
+_aggregates_lock = threading.Lock()
+_aggregates_state: Dict[str, Any] = {"stamp": None, "data": None}
+
+
+def _sales_stamp() -> Any:
+    if SALES_STORAGE == "journal":
+        return _journal_stamp()
+    if SALES_STORAGE == "monthly":
+        return _shards_stamp()
+    return _file_stamp(SALES_FILE)
+
+
+def _sale_aggregate_keys(sale: Dict[str, Any]) -> List[Tuple[str, str, str]]:
+    """(dimension, key, display name) triples a sale counts towards."""
+    customer = sale.get("customer")
+    customer_name = customer.get("name", "") if isinstance(customer, dict) else str(customer or "")
+    product_name = str(sale.get("product") or "")
+    seller = str(sale.get("seller") or "")
+    return [
+        # manual sales without an inventory product are grouped by name
+        ("product", sale.get("product_id") or product_name, product_name),
+        ("seller", seller, seller),
+        ("customer", customer_name, customer_name),
+    ]
+
+
+def _sale_amounts(sale: Dict[str, Any]) -> Tuple[float, float]:
+    qty = sale.get("quantity", 0)
+    price = sale.get("price", 0)
+    if not isinstance(qty, (int, float)) or not isinstance(price, (int, float)):
+        return 0.0, 0.0
+    return float(qty), float(qty * price)
+
+
+def _apply_sale_aggregates(data: Dict[str, Dict[str, Dict[str, Any]]], sale: Dict[str, Any], sign: int) -> None:
+    units, revenue = _sale_amounts(sale)
+    for dimension, key, name in _sale_aggregate_keys(sale):
+        entry = data[dimension].setdefault(key, {"name": name, "units": 0.0, "revenue": 0.0, "count": 0})
+        entry["units"] += sign * units
+        entry["revenue"] += sign * revenue
+        entry["count"] += sign
+        if name:
+            entry["name"] = name
+        if entry["count"] <= 0:
+            del data[dimension][key]
+
+
+def _compute_aggregates(sales: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    data: Dict[str, Dict[str, Dict[str, Any]]] = {dimension: {} for dimension in AGGREGATE_DIMENSIONS}
+    for sale in sales:
+        _apply_sale_aggregates(data, sale, 1)
+    return data
+
+
+def _note_sales_change(before: Any, removed: List[Dict[str, Any]], added: List[Dict[str, Any]]) -> None:
+    """Fold a write into the in-memory aggregates if they matched the data it was applied to."""
+    invalidate_fragments("sales")
+    with _aggregates_lock:
+        if _aggregates_state["data"] is None or _aggregates_state["stamp"] != before:
+            return
+        for sale in removed:
+            _apply_sale_aggregates(_aggregates_state["data"], sale, -1)
+        for sale in added:
+            _apply_sale_aggregates(_aggregates_state["data"], sale, 1)
+        _aggregates_state["stamp"] = _sales_stamp()
+
+
+def _db_adjust_aggregates(removed: List[Dict[str, Any]], added: List[Dict[str, Any]]) -> None:
+    rows = []
+    for sale, sign in [(s, -1) for s in removed] + [(s, 1) for s in added]:
+        units, revenue = _sale_amounts(sale)
+        for dimension, key, name in _sale_aggregate_keys(sale):
+            rows.append((dimension, key, name, sign * units, sign * revenue, sign))
+    with _db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO sales_aggregates (dimension, key, name, units, revenue, count) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(dimension, key) DO UPDATE SET "
+            "name = CASE WHEN excluded.name != '' THEN excluded.name ELSE name END, "
+            "units = units + excluded.units, revenue = revenue + excluded.revenue, count = count + excluded.count",
+            rows,
+        )
+        conn.execute("DELETE FROM sales_aggregates WHERE count <= 0")
+
+
+def rebuild_sales_aggregates() -> None:
+    """Recompute the aggregates from every sale (after migrations or bulk rewrites)."""
+    if STORAGE_BACKEND == "sqlite":
+        with _db_transaction() as conn:
+            conn.execute("DELETE FROM sales_aggregates")
+            _db_adjust_aggregates([], list(iter_sales()))
+        return
+    with _aggregates_lock:
+        _aggregates_state.update({"stamp": None, "data": None})
+
+
+def _current_aggregates() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """In-memory aggregates for the JSON backends, rebuilt if stale. Caller holds the lock."""
+    stamp = _sales_stamp()
+    if _aggregates_state["data"] is None or _aggregates_state["stamp"] != stamp:
+        _aggregates_state.update({"stamp": stamp, "data": _compute_aggregates(iter_sales())})
+    return _aggregates_state["data"]
+
+
+def sales_aggregates() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """All aggregates as {dimension: {key: {name, units, revenue, count}}}."""
+    if STORAGE_BACKEND == "sqlite":
+        data: Dict[str, Dict[str, Dict[str, Any]]] = {dimension: {} for dimension in AGGREGATE_DIMENSIONS}
+        rows = _db().execute("SELECT dimension, key, name, units, revenue, count FROM sales_aggregates")
+        for dimension, key, name, units, revenue, count in rows:
+            data[dimension][key] = {"name": name, "units": units, "revenue": revenue, "count": count}
+        return data
+    with _aggregates_lock:
+        return {
+            dimension: {key: dict(entry) for key, entry in entries.items()}
+            for dimension, entries in _current_aggregates().items()
+        }
+
+
+def sales_aggregates_between(lower: str | None, upper: str | None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Aggregates over the sales created in [lower, upper); the whole history when both are None.
+
+    Ranges are computed from the sales themselves, reading only the months
+    they cover when sales are sharded.
+    """
+    if lower is None and upper is None:
+        return sales_aggregates()
+    return _compute_aggregates(iter_sales(lower, upper))
+
+
+def sales_aggregate(dimension: str, key: str) -> Dict[str, Any] | None:
+    """A single aggregate, e.g. ``sales_aggregate("seller", "Administrador")``."""
+    if STORAGE_BACKEND == "sqlite":
+        row = _db().execute(
+            "SELECT name, units, revenue, count FROM sales_aggregates WHERE dimension = ? AND key = ?",
+            (dimension, key),
+        ).fetchone()
+        return {"name": row[0], "units": row[1], "revenue": row[2], "count": row[3]} if row else None
+    with _aggregates_lock:
+        entry = _current_aggregates().get(dimension, {}).get(key)
+        return dict(entry) if entry is not None else None
+
+
+# ----- Schema migrations -----
+# Stored sales carry a schema version (``schema_version`` in sales.json,
+# ``PRAGMA user_version`` in SQLite). Migrations upgrade every stored sale
+# once, at startup or with `flask migrate-data`, so request handlers can rely
+# on the current shape instead of fixing records up on every read.
+def _normalize_customer(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """v1: ``customer`` is always a {name, email, phone} dict (older sales stored a string or nothing)."""
+    cust = sale.get("customer")
+    if isinstance(cust, dict):
+        sale["customer"] = {"name": cust.get("name", ""), "email": cust.get("email", ""), "phone": cust.get("phone", "")}
+    else:
+        sale["customer"] = {"name": cust or "", "email": "", "phone": ""}
+    return sale
+
+
+def _add_created_at(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """v2: every sale has ``created_at``; it is None for sales recorded before timestamps existed."""
+    sale.setdefault("created_at", None)
+    return sale
+
+
+_legacy_seq = itertools.count(1)
+
+
+def _add_seq(sale: Dict[str, Any]) -> Dict[str, Any]:
+    """v3: every sale has ``seq`` (see new_seq); older sales are numbered in storage order."""
+    if "seq" not in sale:
+        sale["seq"] = next(_legacy_seq)
+    return sale
+
+
+# (version, per-sale upgrade), in order
+SCHEMA_MIGRATIONS = [
+    (1, _normalize_customer),
+    (2, _add_created_at),
+    (3, _add_seq),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+def schema_version() -> int:
+    if STORAGE_BACKEND == "sqlite":
+        return _db().execute("PRAGMA user_version").fetchone()[0]
+    if SALES_STORAGE == "monthly":
+        names = _shard_names()
+        if not names:
+            return SCHEMA_VERSION
+        return min(int(load_json(_shard_path(name)).get("schema_version", 0)) for name in names)
+    return int(load_json(SALES_FILE).get("schema_version", 0))
+
+
+def migrate_data() -> List[int]:
+    """Apply pending migrations to the stored sales; returns the versions applied."""
+    if STORAGE_BACKEND != "sqlite" and SALES_STORAGE == "monthly":
+        shard_sales()
+    with write_transaction(SALES_FILE):
+        current = schema_version()
+        pending = [(version, upgrade) for version, upgrade in SCHEMA_MIGRATIONS if version > current]
+        if not pending:
+            return []
+        sales = get_sales()
+        for _, upgrade in pending:
+            sales = [upgrade(sale) for sale in sales]
+        # persist_sales stamps the JSON snapshot with SCHEMA_VERSION
+        persist_sales(sales)
+        if STORAGE_BACKEND == "sqlite":
+            _db().execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return [version for version, _ in pending]
+
+
+# ----- Product search index -----
+# Inverted index from name/SKU tokens to product ids, plus a sorted list of
+# every token so prefixes are found with a binary search. Product writes made
+# by this process are applied to it directly; it is tagged with the
+# catalog_version() it matches and rebuilt when another process changed the
+# catalog.
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+
+_search_lock = threading.Lock()
+_search_index: Dict[str, Any] = {"version": None, "postings": {}, "terms": [], "docs": {}, "doc_terms": {}}
+
+
+def _search_tokens(text: str) -> List[str]:
+    # lowercase and drop accents so "lampara" finds "Lámpara"
+    folded = unicodedata.normalize("NFKD", text.lower())
+    return re.findall(r"\w+", "".join(c for c in folded if not unicodedata.combining(c)))
+
+
+def _index_add(index: Dict[str, Any], prod: Dict[str, Any]) -> None:
+    pid = prod.get("id")
+    name = str(prod.get("name") or "")
+    sku = str(prod.get("sku") or "")
+    terms = set(_search_tokens(name)) | set(_search_tokens(sku))
+    index["docs"][pid] = {
+        "id": pid,
+        "name": name,
+        "sku": sku,
+        "price": prod.get("price"),
+        "stock": prod.get("stock"),
+        "_rank": " ".join(_search_tokens(name)),
+    }
+    index["doc_terms"][pid] = terms
+    for term in terms:
+        ids = index["postings"].get(term)
+        if ids is None:
+            index["postings"][term] = {pid}
+            bisect.insort(index["terms"], term)
+        else:
+            ids.add(pid)
+
+
+def _index_remove(index: Dict[str, Any], pid: str) -> None:
+    for term in index["doc_terms"].pop(pid, ()):
+        ids = index["postings"][term]
+        ids.discard(pid)
+        if not ids:
+            del index["postings"][term]
+            del index["terms"][bisect.bisect_left(index["terms"], term)]
+    index["docs"].pop(pid, None)
+
+
+def _current_search_index() -> Dict[str, Any]:
+    """The index, rebuilt if the catalog changed behind our back. Caller holds the lock."""
+    version = catalog_version()
+    if _search_index["version"] != version:
+        _search_index.update({"version": version, "postings": {}, "terms": [], "docs": {}, "doc_terms": {}})
+        for prod in iter_products():
+            _index_add(_search_index, prod)
+    return _search_index
+
+
+def _note_products_change(before: int, removed: List[str], added: List[Dict[str, Any]]) -> None:
+    """Apply a product write to the index if it matched the catalog the write started from."""
+    invalidate_fragments("products")
+    with _search_lock:
+        if _search_index["version"] != before:
+            return
+        for pid in removed:
+            _index_remove(_search_index, pid)
+        for prod in added:
+            _index_add(_search_index, prod)
+        _search_index["version"] = catalog_version()
+
+
+def search_products(query: str, limit: int = SEARCH_LIMIT) -> List[Dict[str, Any]]:
+    """Top ``limit`` products whose name or SKU has a word starting with each query word."""
+    terms = sorted(set(_search_tokens(query)), key=len, reverse=True)
+    if not terms:
+        return []
+    with _search_lock:
+        index = _current_search_index()
+        # the longest word usually matches the fewest products: collect those,
+        # then check the remaining words against each candidate's own terms
+        first = terms[0]
+        candidates = set()
+        position = bisect.bisect_left(index["terms"], first)
+        while position < len(index["terms"]) and index["terms"][position].startswith(first):
+            candidates |= index["postings"][index["terms"][position]]
+            position += 1
+        for term in terms[1:]:
+            candidates = {
+                pid for pid in candidates if any(t.startswith(term) for t in index["doc_terms"][pid])
+            }
+        phrase = " ".join(_search_tokens(query))
+        docs = index["docs"]
+        best = heapq.nsmallest(
+            limit,
+            candidates,
+            key=lambda pid: (not docs[pid]["_rank"].startswith(phrase), len(docs[pid]["_rank"]), docs[pid]["_rank"]),
+        )
+        return [{k: v for k, v in docs[pid].items() if k != "_rank"} for pid in best]
+
+
+# ----- Validation -----
+# Shared by the create/edit forms and the bulk import so every way of adding
+# data applies the same rules and messages.
+def validate_product_fields(name: str, price: str, stock: str) -> Tuple[float, int, List[str]]:
+    """Parse a product's price and stock; returns (price, stock, errors)."""
+    errors = []
+    if not name:
+        errors.append("El nombre es obligatorio.")
+    price_value, stock_value = 0.0, 0
+    try:
+        price_value = float(price) if price else 0.0
+        if price_value < 0:
+            errors.append("El precio debe ser positivo.")
+    except ValueError:
+        errors.append("El precio debe ser numérico.")
+    try:
+        stock_value = int(stock) if stock else 0
+        if stock_value < 0:
+            errors.append("El stock no puede ser negativo.")
+    except ValueError:
+        errors.append("El stock debe ser un número entero.")
+    return price_value, stock_value, errors
+
+
+def validate_sale_fields(product: str, quantity: str, price: str) -> Tuple[int, float, List[str]]:
+    """Parse a sale's quantity and price; returns (quantity, price, errors)."""
+    errors = []
+    if not product:
+        errors.append("El producto es obligatorio.")
+    if not quantity or not quantity.isdigit():
+        errors.append("La cantidad debe ser un número entero.")
+    if not price:
+        errors.append("El precio es obligatorio.")
+    price_value = 0.0
+    try:
+        price_value = float(price)
+        if price_value < 0:
+            errors.append("El precio debe ser positivo.")
+    except ValueError:
+        errors.append("El precio debe ser numérico.")
+    quantity_value = int(quantity) if quantity.isdigit() else 0
+    return quantity_value, price_value, errors
+
+
+# ----- Bulk import -----
+# Uploads are read a row at a time (csv module, or openpyxl in read-only mode)
+# and written in batches of IMPORT_BATCH_SIZE, each batch being one
+# save_products/add_sales call, so a large catalog costs a few dozen persists
+# instead of one per row.
+IMPORT_BATCH_SIZE = 1000
+# accepted column names, including the ones the Excel/CSV reports export
+IMPORT_COLUMNS = {
+    "products": {
+        "name": ("name", "nombre"),
+        "sku": ("sku",),
+        "price": ("price", "precio"),
+        "stock": ("stock",),
+    },
+    "sales": {
+        "product": ("product", "producto"),
+        "product_id": ("product_id",),
+        "sku": ("sku",),
+        "quantity": ("quantity", "cantidad"),
+        "price": ("price", "precio"),
+        "seller": ("seller", "vendedor"),
+        "customer_name": ("customer_name", "cliente"),
+        "customer_email": ("customer_email", "email"),
+        "customer_phone": ("customer_phone", "telefono", "teléfono"),
+        "created_at": ("created_at", "fecha"),
+    },
+}
+
+
+def _cell_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        # spreadsheets hand integers back as floats; keep "3" a valid stock
+        return str(int(value))
+    return str(value).strip()
+
+
+def iter_import_rows(stream: IO[bytes], filename: str) -> Iterator[Tuple[int, List[str], List[Any]]]:
+    """Yield (line number, header, row) for each data row of a CSV or XLSX upload."""
+    if filename.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = [_cell_text(c).lower() for c in next(rows, ())]
+            for number, row in enumerate(rows, start=2):
+                yield number, header, list(row)
+        finally:
+            wb.close()
+        return
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        sample = text.read(4096)
+        text.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t") if sample else csv.excel
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = [_cell_text(c).lower() for c in next(reader, [])]
+    for row in reader:
+        yield reader.line_num, header, row
+
+
+def _import_records(rows: Iterable[Tuple[int, List[str], List[Any]]], kind: str) -> Iterator[Tuple[int, Dict[str, str]]]:
+    columns = IMPORT_COLUMNS[kind]
+    positions: Dict[str, int] = {}
+    for number, header, row in rows:
+        if not positions:
+            for field, names in columns.items():
+                for name in names:
+                    if name in header:
+                        positions[field] = header.index(name)
+                        break
+            if not positions:
+                raise ValueError("El archivo no tiene encabezados reconocidos.")
+        values = {field: _cell_text(row[i]) if i < len(row) else "" for field, i in positions.items()}
+        if any(values.values()):
+            yield number, values
+
+
+def new_import_report() -> Dict[str, Any]:
+    """Counts for import_products/import_sales; ``written`` is the rows already saved."""
+    return {"created": 0, "updated": 0, "written": 0, "errors": []}
+
+
+def import_products(rows: Iterable[Tuple[int, List[str], List[Any]]], report: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """Create or update products from import rows, matching existing ones by SKU.
+
+    An update only changes the columns the row fills in. Pass ``report`` to
+    keep the counts when reading the rows fails partway.
+    """
+    by_sku = {p["sku"]: p["id"] for p in iter_products() if p.get("sku")}
+    report = new_import_report() if report is None else report
+    batch: Dict[str, Dict[str, Any]] = {}
+    updates: Dict[str, Dict[str, Any]] = {}
+
+    def flush() -> None:
+        # updated rows keep the image and any other fields of the stored
+        # product; read and write under one lock so a sale taking stock in
+        # between is not overwritten with the stock read here
+        with write_transaction(PRODUCTS_FILE):
+            for product_id, prod in get_products_by_id(updates).items():
+                prod.update(updates[product_id])
+                batch[product_id] = prod
+            if batch:
+                save_products(list(batch.values()))
+                report["written"] += len(batch)
+        batch.clear()
+        updates.clear()
+
+    for number, values in _import_records(rows, "products"):
+        name, sku = values.get("name", ""), values.get("sku", "")
+        product_id = by_sku.get(sku) if sku else None
+        # a row updating a product found by SKU may leave the name out
+        price_value, stock_value, errors = validate_product_fields(
+            name or (sku if product_id else ""), values.get("price", ""), values.get("stock", "")
+        )
+        if errors:
+            report["errors"].append({"row": number, "errors": errors})
+            continue
+        fields = {"name": name, "sku": sku, "price": price_value, "stock": stock_value}
+        if product_id is not None:
+            # the defaults for missing or empty columns are only for new products
+            fields = {k: v for k, v in fields.items() if values.get(k)}
+        if product_id is None:
+            prod = {"id": str(uuid4()), **fields, "image": ""}
+            if sku:
+                by_sku[sku] = prod["id"]
+            batch[prod["id"]] = prod
+            report["created"] += 1
+        elif product_id in batch:
+            # created earlier in this same batch
+            batch[product_id].update(fields)
+            report["updated"] += 1
+        else:
+            updates[product_id] = fields
+            report["updated"] += 1
+        if len(batch) + len(updates) >= IMPORT_BATCH_SIZE:
+            flush()
+    flush()
+    return report
+
+
+def _import_timestamp(text: str) -> str | None:
+    """created_at for an imported row: now when empty, None when unparseable."""
+    if not text:
+        return utc_now()
+    # spreadsheets give "2025-03-14 09:26:53" for datetime cells
+    for fmt in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%dT%H:%M:%SZ")
+        except ValueError:
+            continue
+    return None
+
+
+def import_sales(
+    rows: Iterable[Tuple[int, List[str], List[Any]]], seller: str, report: Dict[str, Any] | None = None
+) -> Dict[str, Any]:
+    """Record sales from import rows; stock is left as is, as for historical data.
+
+    A row may name its product by product_id, by SKU or by free text; the
+    price defaults to the product's price, as in the sale form. ``report`` is
+    as for import_products.
+    """
+    catalog: Dict[str, Tuple[str, Any]] = {}
+    by_sku: Dict[str, str] = {}
+    for p in iter_products():
+        catalog[p.get("id")] = (p.get("name", ""), p.get("price", ""))
+        if p.get("sku"):
+            by_sku[p["sku"]] = p.get("id")
+    report = new_import_report() if report is None else report
+    batch: List[Dict[str, Any]] = []
+    for number, values in _import_records(rows, "sales"):
+        product, price = values.get("product", ""), values.get("price", "")
+        product_id = values.get("product_id", "")
+        if not product_id and values.get("sku"):
+            # an unknown SKU is kept as the id so it is reported as missing below
+            product_id = by_sku.get(values["sku"], values["sku"])
+        if product_id:
+            if product_id not in catalog:
+                report["errors"].append({"row": number, "errors": ["El producto no existe."]})
+                continue
+            product, catalog_price = catalog[product_id]
+            if not price:
+                price = str(catalog_price)
+        quantity_value, price_value, errors = validate_sale_fields(product, values.get("quantity", ""), price)
+        created_at = _import_timestamp(values.get("created_at", ""))
+        if created_at is None:
+            errors.append("La fecha debe tener el formato AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS.")
+        if errors:
+            report["errors"].append({"row": number, "errors": errors})
+            continue
+        batch.append(
+            {
+                "id": str(uuid4()),
+                "product": product,
+                "product_id": product_id,
+                "quantity": quantity_value,
+                "price": price_value,
+                "customer": {
+                    "name": values.get("customer_name", ""),
+                    "email": values.get("customer_email", ""),
+                    "phone": values.get("customer_phone", ""),
+                },
+                "seller": values.get("seller") or seller,
+                "created_at": created_at,
+            }
+        )
+        report["created"] += 1
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            add_sales(batch)
+            report["written"] += len(batch)
+            batch = []
+    if batch:
+        add_sales(batch)
+        report["written"] += len(batch)
+    return report
+
+
+def find_user(username: str) -> Dict[str, Any] | None:
+    if STORAGE_BACKEND == "sqlite":
+        return _db_get("users", "username", username)
+    for user in get_users():
+        if user.get("username") == username:
+            return user
+    return None
+
+
+# ----- Streaming reads -----
+# Walk every record without building a copied list; for listings, reports and
+# other full scans. With the JSON backends the records are the cached ones and
+# must not be mutated.
+def iter_sales(lower: str | None = None, upper: str | None = None) -> Iterator[Dict[str, Any]]:
+    """Every sale, or those whose created_at is in [lower, upper) (see date_bounds)."""
+    ranged = lower is not None or upper is not None
+    if STORAGE_BACKEND == "sqlite":
+        if not ranged:
+            return (json.loads(row[0]) for row in _db().execute("SELECT doc FROM sales ORDER BY seq"))
+        rows = _db().execute(
+            "SELECT doc FROM sales WHERE created_at >= ? AND created_at < ? ORDER BY seq",
+            (lower or "", upper or "\uffff"),
+        )
+        return (json.loads(row[0]) for row in rows)
+    if SALES_STORAGE == "journal":
+        sales: Iterable[Dict[str, Any]] = list(_journaled_sales().values())
+    elif SALES_STORAGE == "monthly":
+        sales = (sale for name in _shard_names(lower, upper) for sale in _shard_sales(name))
+    else:
+        sales = load_json(SALES_FILE).get("sales", [])
+    if ranged:
+        return (sale for sale in sales if _in_date_range(sale, lower, upper))
+    return iter(sales)
+
+
+def iter_products() -> Iterator[Dict[str, Any]]:
+    if STORAGE_BACKEND == "sqlite":
+        return (json.loads(row[0]) for row in _db().execute("SELECT doc FROM products ORDER BY seq"))
+    return iter(load_json(PRODUCTS_FILE).get("products", []))
+
+
+# ----- Listing queries -----
+# /ventas and /inventario show one page at a time. Pages are keyset based: the
+# cursor carries the position of the last row shown (its seq, or its sort
+# value, plus its id), so the next page starts right after it without
+# counting the rows before, even if that row was deleted meanwhile.
+#
+# JSON lists are kept in seq order, so a default-order page is a binary
+# search plus a walk of the page (monthly shards are merged by seq, so the
+# default order is the order sales were recorded in, as with the other modes). Sorted pages walk an index of (sort value,
+# id) pairs that is built once per data version and sort. With SQLite the
+# filters, ordering and limit run in the database, on expression indexes.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+LISTING_INDEXES_KEEP = 16
+
+# sort name -> (record field, numeric); a leading "-" in the request sorts descending
+SALE_SORTS: Dict[str, Tuple[str, bool]] = {
+    "product": ("product", False),
+    "seller": ("seller", False),
+    "quantity": ("quantity", True),
+    "price": ("price", True),
+    "created_at": ("created_at", False),
+}
+PRODUCT_SORTS: Dict[str, Tuple[str, bool]] = {
+    "name": ("name", False),
+    "sku": ("sku", False),
+    "price": ("price", True),
+    "stock": ("stock", True),
+}
+
+_SQL_CUSTOMER_TEXT = (
+    "CASE json_type(doc, '$.customer') WHEN 'object' THEN "
+    "COALESCE(json_extract(doc, '$.customer.name'), '') || ' ' || "
+    "COALESCE(json_extract(doc, '$.customer.email'), '') || ' ' || "
+    "COALESCE(json_extract(doc, '$.customer.phone'), '') "
+    "ELSE COALESCE(json_extract(doc, '$.customer'), '') END"
+)
+
+
+def encode_cursor(sort: str, value: Any, record_id: str) -> str:
+    raw = json.dumps([sort, value, record_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str | None, sort: str) -> Tuple[Any, str] | None:
+    """Return (value, id) from a cursor made for ``sort``; anything else starts from the top."""
+    if not cursor:
+        return None
+    try:
+        cursor_sort, value, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if cursor_sort != sort:
+        return None
+    return (value, record_id)
+
+
+def _cursor_position(cursor: str | None, sort: str, sorts: Dict[str, Tuple[str, bool]]) -> Tuple[Any, str] | None:
+    """decode_cursor, also dropping positions of the wrong type (e.g. cursors from older versions)."""
+    after = decode_cursor(cursor, sort)
+    if after is None:
+        return None
+    spec = sorts.get(sort.lstrip("-"))
+    value, record_id = after
+    if spec is None or spec[1]:
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    else:
+        valid = isinstance(value, str)
+    return (value, record_id) if valid and isinstance(record_id, str) else None
+
+
+def _parse_float(value: str | None) -> float | None:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _sort_value(record: Dict[str, Any], field: str, numeric: bool) -> Any:
+    value = record.get(field)
+    if numeric:
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0.0
+    return str(value or "").lower()
+
+
+def _customer_text(customer: Any) -> str:
+    if isinstance(customer, dict):
+        return " ".join(str(customer.get(k) or "") for k in ("name", "email", "phone"))
+    return str(customer or "")
+
+
+def _seq_key(record: Dict[str, Any]) -> Tuple[int, str]:
+    return (record.get("seq") or 0, record.get("id", ""))
+
+
+_listing_lock = threading.Lock()
+_listing_indexes: "OrderedDict[Tuple[Any, ...], List[Any]]" = OrderedDict()
+
+
+def _listing_index(key: Tuple[Any, ...], build: Any) -> List[Any]:
+    """The list ``build()`` returns, kept for the LISTING_INDEXES_KEEP most recent keys.
+
+    Keys include the data version they were built from, so stale ones just
+    fall out.
+    """
+    with _listing_lock:
+        index = _listing_indexes.get(key)
+        if index is not None:
+            _listing_indexes.move_to_end(key)
+            return index
+    index = build()
+    with _listing_lock:
+        _listing_indexes[key] = index
+        while len(_listing_indexes) > LISTING_INDEXES_KEEP:
+            _listing_indexes.popitem(last=False)
+    return index
+
+
+def _page_records(
+    sources: List[List[Dict[str, Any]]],
+    records: Any,
+    matches: Any,
+    key: Tuple[Any, ...],
+    sort: str,
+    sorts: Dict[str, Tuple[str, bool]],
+    cursor: str | None,
+    limit: int,
+) -> Tuple[List[Dict[str, Any]], str | None]:
+    """Keyset page over in-memory records, walking only from the cursor on.
+
+    ``sources`` are lists in seq order, read for the default order;
+    ``records()`` yields everything for building a sort index, cached under
+    ``key`` (which names the data version). Rows are kept when ``matches``.
+    """
+    bound = _cursor_position(cursor, sort, sorts)
+    spec = sorts.get(sort.lstrip("-"))
+    if spec is None:
+        starts = [bisect.bisect_right(src, bound, key=_seq_key) if bound else 0 for src in sources]
+        walk = heapq.merge(*(itertools.islice(src, start, None) for src, start in zip(sources, starts)), key=_seq_key)
+        position = _seq_key
+    else:
+        field, numeric = spec
+        index = _listing_index(
+            key + (field,),
+            lambda: sorted((((_sort_value(r, field, numeric), r.get("id", "")), r) for r in records()), key=lambda kr: kr[0]),
+        )
+        if sort.startswith("-"):
+            stop = bisect.bisect_left(index, bound, key=lambda kr: kr[0]) if bound else len(index)
+            walk = (index[i][1] for i in range(stop - 1, -1, -1))
+        else:
+            begin = bisect.bisect_right(index, bound, key=lambda kr: kr[0]) if bound else 0
+            walk = (index[i][1] for i in range(begin, len(index)))
+
+        def position(record: Dict[str, Any]) -> Tuple[Any, str]:
+            return (_sort_value(record, field, numeric), record.get("id", ""))
+
+    page: List[Dict[str, Any]] = []
+    for record in walk:
+        if matches(record):
+            page.append(record)
+            if len(page) > limit:
+                break
+    has_more = len(page) > limit
+    page = page[:limit]
+    return page, encode_cursor(sort, *position(page[-1])) if has_more else None
+
+
+def _db_sort_expr(field: str, numeric: bool) -> str:
+    # the listing indexes are built on these exact expressions (see _db)
+    if numeric:
+        return f"CAST(COALESCE(json_extract(doc, '$.{field}'), 0) AS REAL)"
+    return f"lower(COALESCE(json_extract(doc, '$.{field}'), ''))"
+
+
+def _db_page(
+    table: str,
+    where: List[str],
+    params: List[Any],
+    sort: str,
+    sorts: Dict[str, Tuple[str, bool]],
+    cursor: str | None,
+    limit: int,
+) -> Tuple[List[Dict[str, Any]], str | None]:
+    after = _cursor_position(cursor, sort, sorts)
+    spec = sorts.get(sort.lstrip("-"))
+    where, params = list(where), list(params)
+    if spec is None:
+        sort_expr, order = "seq", "seq"
+        if after is not None:
+            where.append("seq > ?")
+            params.append(after[0])
+    else:
+        sort_expr = _db_sort_expr(*spec)
+        direction = "DESC" if sort.startswith("-") else "ASC"
+        order = f"{sort_expr} {direction}, id {direction}"
+        if after is not None:
+            where.append(f"({sort_expr}, id) {'<' if direction == 'DESC' else '>'} (?, ?)")
+            params.extend(after)
+    sql = f"SELECT doc, {sort_expr}, id FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    rows = _db().execute(sql, (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(sort, rows[-1][1], rows[-1][2]) if has_more else None
+    return [json.loads(row[0]) for row in rows], next_cursor
+
+
+def _like(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def query_sales(
+    filters: Dict[str, str], sort: str = "", cursor: str | None = None, limit: int = PAGE_SIZE
+) -> Tuple[List[Dict[str, Any]], str | None]:
+    """One page of sales matching ``filters`` and the cursor for the next page (or None).
+
+    Filters: ``product`` and ``customer`` match substrings, ``seller`` and
+    ``product_id`` match exactly, ``price_min``/``price_max`` bound the unit price
+    and ``date_from``/``date_to`` (YYYY-MM-DD, inclusive) the day of created_at.
+    """
+    product = (filters.get("product") or "").lower()
+    customer = (filters.get("customer") or "").lower()
+    seller = filters.get("seller") or ""
+    product_id = filters.get("product_id") or ""
+    price_min = _parse_float(filters.get("price_min"))
+    price_max = _parse_float(filters.get("price_max"))
+    lower, upper = date_bounds(filters.get("date_from"), filters.get("date_to"))
+
+    if STORAGE_BACKEND == "sqlite":
+        where: List[str] = []
+        params: List[Any] = []
+        if lower is not None:
+            where.append("created_at >= ?")
+            params.append(lower)
+        if upper is not None:
+            where.append("created_at < ?")
+            params.append(upper)
+        if product:
+            where.append("json_extract(doc, '$.product') LIKE ? ESCAPE '\\'")
+            params.append(_like(product))
+        if customer:
+            where.append(f"{_SQL_CUSTOMER_TEXT} LIKE ? ESCAPE '\\'")
+            params.append(_like(customer))
+        if seller:
+            where.append("seller = ?")
+            params.append(seller)
+        if product_id:
+            where.append("product_id = ?")
+            params.append(product_id)
+        if price_min is not None:
+            where.append("json_extract(doc, '$.price') >= ?")
+            params.append(price_min)
+        if price_max is not None:
+            where.append("json_extract(doc, '$.price') <= ?")
+            params.append(price_max)
+        return _db_page("sales", where, params, sort, SALE_SORTS, cursor, limit)
+
+    def matches(sale: Dict[str, Any]) -> bool:
+        if not _in_date_range(sale, lower, upper):
+            return False
+        if product and product not in str(sale.get("product") or "").lower():
+            return False
+        if customer and customer not in _customer_text(sale.get("customer")).lower():
+            return False
+        if seller and sale.get("seller") != seller:
+            return False
+        if product_id and sale.get("product_id") != product_id:
+            return False
+        price = _sort_value(sale, "price", True)
+        if price_min is not None and price < price_min:
+            return False
+        if price_max is not None and price > price_max:
+            return False
+        return True
+
+    version = sales_version()
+    if SALES_STORAGE == "journal":
+        sources = [_listing_index(("sales", version), lambda: list(_journaled_sales().values()))]
+    elif SALES_STORAGE == "monthly":
+        # only the months in the date range are read
+        sources = [_shard_sales(name) for name in _shard_names(lower, upper)]
+    else:
+        sources = [load_json(SALES_FILE).get("sales", [])]
+    page, next_cursor = _page_records(
+        sources, lambda: iter_sales(lower, upper), matches, ("sales", version, lower, upper), sort, SALE_SORTS, cursor, limit
+    )
+    return _copy_records(page), next_cursor
+
+
+def query_products(
+    filters: Dict[str, str], sort: str = "", cursor: str | None = None, limit: int = PAGE_SIZE
+) -> Tuple[List[Dict[str, Any]], str | None]:
+    """One page of products; ``q`` matches name or SKU, ``price_min``/``price_max`` bound the price."""
+    q = (filters.get("q") or "").lower()
+    price_min = _parse_float(filters.get("price_min"))
+    price_max = _parse_float(filters.get("price_max"))
+
+    if STORAGE_BACKEND == "sqlite":
+        where = []
+        params: List[Any] = []
+        if q:
+            where.append("(json_extract(doc, '$.name') LIKE ? ESCAPE '\\' OR sku LIKE ? ESCAPE '\\')")
+            params.extend([_like(q), _like(q)])
+        if price_min is not None:
+            where.append("json_extract(doc, '$.price') >= ?")
+            params.append(price_min)
+        if price_max is not None:
+            where.append("json_extract(doc, '$.price') <= ?")
+            params.append(price_max)
+        return _db_page("products", where, params, sort, PRODUCT_SORTS, cursor, limit)
+
+    def matches(prod: Dict[str, Any]) -> bool:
+        if q and q not in str(prod.get("name") or "").lower() and q not in str(prod.get("sku") or "").lower():
+            return False
+        price = _sort_value(prod, "price", True)
+        if price_min is not None and price < price_min:
+            return False
+        if price_max is not None and price > price_max:
+            return False
+        return True
+
+    data = load_json(PRODUCTS_FILE)
+    products = data.get("products", [])
+    # the version of this very payload (see catalog_version)
+    key = ("products", int(data.get("version", 0)))
+    page, next_cursor = _page_records([products], lambda: products, matches, key, sort, PRODUCT_SORTS, cursor, limit)
+    return _copy_records(page), next_cursor
+
+
+# ----- Sales reports -----
+# The Excel report is built on a small thread pool and kept on disk in
+# REPORTS_DIR under the data_version() it was built from, so asking again for
+# an unchanged dataset just sends the stored file. That version is also the
+# job id: any worker can answer for it, and asking while a build for the same
+# data is running joins that build instead of starting another.
+REPORTS_DIR = DATA_DIR / "reports"
+REPORT_WORKERS = int(os.environ.get("SHOP_REPORT_WORKERS", "2"))
+REPORT_CACHE_KEEP = 5
+_REPORT_ID = re.compile(r"^[0-9a-f]{16}$")
+SALES_REPORT_HEADER = [
+    "id",
+    "product",
+    "quantity",
+    "price",
+    "seller",
+    "customer_name",
+    "customer_email",
+    "customer_phone",
+    "total",
+    "created_at",
+]
+INVENTORY_REPORT_HEADER = ["inventory_id", "name", "sku", "price", "stock"]
+
+_report_lock = threading.Lock()
+_report_jobs: Dict[str, Dict[str, Any]] = {}
+_report_pool: Dict[str, ThreadPoolExecutor] = {}
+
+
+def sales_version() -> Any:
+    """Changes with every sale write, like catalog_version() does for products."""
+    if STORAGE_BACKEND == "sqlite":
+        row = _db().execute("SELECT value FROM meta WHERE key = 'sales_version'").fetchone()
+        return int(row[0]) if row else 0
+    return _sales_stamp()
+
+
+def data_version() -> str:
+    """Short hash that changes whenever any product or sale does."""
+    return hashlib.sha1(json.dumps([catalog_version(), sales_version()]).encode()).hexdigest()[:16]
+
+
+def report_id(lower: str | None = None, upper: str | None = None) -> str:
+    """Name of the report for the current data, limited to a created_at range."""
+    if lower is None and upper is None:
+        return data_version()
+    return hashlib.sha1(json.dumps([data_version(), lower, upper]).encode()).hexdigest()[:16]
+
+
+def _sales_report_rows(lower: str | None = None, upper: str | None = None) -> Iterator[List[Any]]:
+    for s in iter_sales(lower, upper):
+        cust = s.get("customer") or {}
+        qty = s.get("quantity", 0)
+        price = s.get("price", 0)
+        total = qty * price if isinstance(qty, (int, float)) and isinstance(price, (int, float)) else ""
+        yield [
+            s.get("id", ""),
+            s.get("product", ""),
+            qty,
+            price,
+            s.get("seller", ""),
+            cust.get("name", ""),
+            cust.get("email", ""),
+            cust.get("phone", ""),
+            total,
+            s.get("created_at") or "",
+        ]
+
+
+def _inventory_report_rows() -> Iterator[List[Any]]:
+    for p in iter_products():
+        yield [p.get("id", ""), p.get("name", ""), p.get("sku", ""), p.get("price", ""), p.get("stock", "")]
+
+
+def write_sales_report(file: IO[bytes], lower: str | None = None, upper: str | None = None) -> None:
+    """Write the Excel report (Sales and Inventory sheets) to ``file``; sales may be limited to a date range."""
+    from openpyxl import Workbook
+
+    # write-only mode streams rows out instead of keeping every cell object
+    wb = Workbook(write_only=True)
+    ws_sales = wb.create_sheet(title="Sales")
+    ws_sales.append(SALES_REPORT_HEADER)
+    for row in _sales_report_rows(lower, upper):
+        ws_sales.append(row)
+
+    ws_inv = wb.create_sheet(title="Inventory")
+    ws_inv.append(INVENTORY_REPORT_HEADER)
+    for row in _inventory_report_rows():
+        ws_inv.append(row)
+
+    wb.save(file)
+
+
+def report_path(job_id: str) -> Path:
+    return REPORTS_DIR / f"reporte-{job_id}.xlsx"
+
+
+def _prune_reports() -> None:
+    reports = sorted(REPORTS_DIR.glob("reporte-*.xlsx"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in reports[REPORT_CACHE_KEEP:]:
+        old.unlink(missing_ok=True)
+
+
+def _run_report_job(job_id: str, lower: str | None, upper: str | None) -> None:
+    job = _report_jobs[job_id]
+    job["status"] = "running"
+    try:
+        # the data may move on while the file is built; it then holds data
+        # at least as new as the version it is named after
+        with timed("shop_section_seconds", section="report_xlsx"):
+            with _atomic_open(report_path(job_id), "wb") as file:
+                write_sales_report(file, lower, upper)
+        _prune_reports()
+    except Exception as exc:
+        with _report_lock:
+            job.update({"status": "error", "error": str(exc) or exc.__class__.__name__})
+        return
+    with _report_lock:
+        # from here on the file on disk is the job's state
+        _report_jobs.pop(job_id, None)
+
+
+def submit_sales_report(lower: str | None = None, upper: str | None = None) -> Dict[str, Any]:
+    """Start, or join, the report build for the current data; returns the job state."""
+    job_id = report_id(lower, upper)
+    with _report_lock:
+        if report_path(job_id).exists():
+            return {"id": job_id, "status": "done", "error": None}
+        job = _report_jobs.get(job_id)
+        if job is None or job["status"] == "error":
+            job = _report_jobs[job_id] = {"id": job_id, "status": "pending", "error": None}
+            pool = _report_pool.get("pool")
+            if pool is None:
+                pool = _report_pool["pool"] = ThreadPoolExecutor(REPORT_WORKERS, thread_name_prefix="report")
+            pool.submit(_run_report_job, job_id, lower, upper)
+        return dict(job)
+
+
+def report_job(job_id: str, lower: str | None = None, upper: str | None = None) -> Dict[str, Any] | None:
+    """State of a report job, or None for an unknown (or no longer current) id.
+
+    ``lower``/``upper`` are the range the job was submitted with.
+    """
+    if not _REPORT_ID.match(job_id):
+        return None
+    if report_path(job_id).exists():
+        return {"id": job_id, "status": "done", "error": None}
+    with _report_lock:
+        job = _report_jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    # started by another worker process, or its file was pruned: build it
+    # here if it still describes the current data
+    if job_id == report_id(lower, upper):
+        return submit_sales_report(lower, upper)
+    return None
+
+
+# ----- Product images -----
+# Uploaded images are stored once under the SHA-256 of their content, with
+# pre-scaled copies per size in IMAGES_DIR/<size>/. Products keep only the
+# file name in ``image``; older records may still carry an inline
+# ``image_base64`` data URI until `flask migrate-images` is run.
+# "s" backs the 48px admin table and "m" the 140px-high buyer card, both at 2x
+# for high-density screens.
+IMAGE_SIZES: Dict[str, Tuple[int, int]] = {"s": (96, 96), "m": (560, 280)}
+IMAGE_MAX_AGE = 60 * 60 * 24 * 365
+_IMAGE_TYPES = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp"}
+_IMAGE_NAME = re.compile(r"^[0-9a-f]{64}\.(png|jpg|gif|webp)$")
+
+
+def store_image(data_uri: str) -> str:
+    """Store a base64 ``data:`` URI and return the image file name.
+
+    Raises ValueError when the URI is not a supported base64 image.
+    """
+    header, sep, encoded = data_uri.partition(",")
+    mime = header[len("data:"):].split(";")[0] if header.startswith("data:") else ""
+    if not sep or not header.endswith(";base64") or mime not in _IMAGE_TYPES:
+        raise ValueError("unsupported image")
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except binascii.Error as exc:
+        raise ValueError("invalid base64") from exc
+    name = f"{hashlib.sha256(raw).hexdigest()}.{_IMAGE_TYPES[mime]}"
+    if not (IMAGES_DIR / name).exists():
+        with _atomic_open(IMAGES_DIR / name, "wb") as file:
+            file.write(raw)
+    _make_thumbnails(name, raw)
+    return name
+
+
+def _make_thumbnails(name: str, raw: bytes) -> None:
+    try:
+        from PIL import Image
+    except Exception:
+        # without Pillow the original is served for every size
+        return
+    for size, box in IMAGE_SIZES.items():
+        target = IMAGES_DIR / size / name
+        if target.exists():
+            continue
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                image_format = img.format
+                img.thumbnail(box)
+                with _atomic_open(target, "wb") as file:
+                    img.save(file, format=image_format)
+        except Exception:
+            # unreadable by Pillow: product_image falls back to the original
+            continue
+
+
+def migrate_inline_images() -> int:
+    """Move inline ``image_base64`` data into the image store. Returns products updated."""
+    with write_transaction(PRODUCTS_FILE):
+        changed = []
+        for prod in get_products():
+            data_uri = prod.pop("image_base64", None)
+            if data_uri is None:
+                continue
+            try:
+                prod["image"] = store_image(data_uri) if data_uri else prod.get("image", "")
+            except ValueError:
+                prod["image"] = ""
+            changed.append(prod)
+        if changed:
+            save_products(changed)
+        return len(changed)
+
+
+# ----- Fragment cache -----
+# Rendered HTML for the product and sales tables, keyed by view, the data
+# version the page was read at and the ids of the records on it. A change
+# bumps the version, so other workers stop hitting their old entries; writes
+# made by this process also drop them right away to free the memory.
+# Templates use it as {% call cached_fragment(scope, version, records) %}.
+FRAGMENT_CACHE_MAX = int(os.environ.get("SHOP_FRAGMENT_CACHE_MAX", "256"))
+_fragment_lock = threading.Lock()
+_fragments: "OrderedDict[Tuple[str, str, str], Markup]" = OrderedDict()
+fragment_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def cached_fragment(scope: str, version: Any, records: Iterable[Dict[str, Any]], caller: Any) -> Markup:
+    ids = "\0".join(str(r.get("id")) for r in records)
+    key = (scope, str(version), hashlib.sha1(ids.encode("utf-8")).hexdigest())
+    with _fragment_lock:
+        html = _fragments.get(key)
+        if html is not None:
+            _fragments.move_to_end(key)
+            fragment_stats["hits"] += 1
+            return html
+        fragment_stats["misses"] += 1
+    html = Markup(caller())
+    with _fragment_lock:
+        _fragments[key] = html
+        while len(_fragments) > FRAGMENT_CACHE_MAX:
+            _fragments.popitem(last=False)
+            fragment_stats["evictions"] += 1
+    return html
+
+
+def invalidate_fragments(prefix: str) -> None:
+    """Drop cached fragments whose scope starts with ``prefix``."""
+    with _fragment_lock:
+        for key in [k for k in _fragments if k[0].startswith(prefix)]:
+            del _fragments[key]
+
+
+# ----- Static assets -----
+# Templates link static files through asset_url(), which puts a hash of the
+# content in the file name (css/styles.<hash>.css). /assets/ serves those
+# names with a one-year immutable lifetime, since an edit changes the URL.
+# Text files are compressed once per version, with gzip and with brotli when
+# that package is installed, and the encoded bodies are kept in memory.
+STATIC_DIR = BASE_DIR / "static"
+ASSET_MAX_AGE = 60 * 60 * 24 * 365
+_COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".html", ".map"}
+_ASSET_NAME = re.compile(r"^(?P<stem>.+)\.(?P<digest>[0-9a-f]{12})(?P<suffix>\.[A-Za-z0-9]+)$")
+_asset_lock = threading.Lock()
+_assets: Dict[str, Dict[str, Any]] = {}
+
+
+def _asset(filename: str) -> Dict[str, Any] | None:
+    """Digest and encoded bodies of static/<filename>, rebuilt when the file changes."""
+    joined = safe_join(str(STATIC_DIR), filename)
+    if joined is None:
+        return None
+    path = Path(joined)
+    stamp = _file_stamp(path)
+    if stamp is None or not path.is_file():
+        return None
+    with _asset_lock:
+        entry = _assets.get(filename)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry
+    raw = path.read_bytes()
+    bodies = {"identity": raw}
+    if path.suffix in _COMPRESSIBLE:
+        candidates = {"gzip": gzip.compress(raw, 9, mtime=0)}
+        if brotli is not None:
+            candidates["br"] = brotli.compress(raw, quality=11)
+        bodies.update({name: body for name, body in candidates.items() if len(body) < len(raw)})
+    entry = {"stamp": stamp, "digest": hashlib.sha256(raw).hexdigest()[:12], "bodies": bodies}
+    with _asset_lock:
+        _assets[filename] = entry
+    return entry
+
+
+def asset_url(filename: str) -> str:
+    """Fingerprinted URL for a static file; a drop-in for url_for("static", filename=...)."""
+    stem, suffix = os.path.splitext(filename)
+    entry = _asset(filename) if suffix else None
+    if entry is None:
+        return url_for("static", filename=filename)
+    return url_for("asset", filename=f"{stem}.{entry['digest']}{suffix}")
+
+
+# ----- Cart store -----
+# Carts live server-side, keyed by a random id that is the only thing the
+# browser keeps in its "cart" cookie. They are stored in their own SQLite
+# file, whatever the data backend, so every worker sees the same cart. Lines
+# are a JSON object keyed by product_id, so a line is found without scanning.
+# Carts expire CART_TTL seconds after their last change; expired rows are
+# swept at most every CART_SWEEP_INTERVAL seconds.
+CART_TTL = 60 * 60 * 24 * 30
+CART_SWEEP_INTERVAL = 10 * 60
+_CART_ID = re.compile(r"^[A-Za-z0-9_-]{22}$")
+_carts_local = threading.local()
+_cart_sweep = {"last": 0.0}
+
+
+def _carts_db() -> sqlite3.Connection:
+    conn = getattr(_carts_local, "conn", None)
+    if conn is None:
+        CARTS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(CARTS_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS carts (
+                id TEXT PRIMARY KEY,
+                lines TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS carts_expires_at ON carts (expires_at);
+            CREATE TABLE IF NOT EXISTS reservations (
+                cart_id TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (cart_id, product_id)
+            );
+            CREATE INDEX IF NOT EXISTS reservations_product ON reservations (product_id, expires_at);
+            """
+        )
+        _carts_local.conn = conn
+    return conn
+
+
+def new_cart_id() -> str:
+    return secrets.token_urlsafe(16)
+
+
+def is_cart_id(value: str | None) -> bool:
+    return bool(value and _CART_ID.match(value))
+
+
+def load_cart(cart_id: str) -> Dict[str, Dict[str, Any]]:
+    """Cart lines keyed by product_id, in the order they were added."""
+    row = _carts_db().execute(
+        "SELECT lines FROM carts WHERE id = ? AND expires_at > ?", (cart_id, time.time())
+    ).fetchone()
+    return json.loads(row[0]) if row else {}
+
+
+def save_cart(cart_id: str, lines: Dict[str, Dict[str, Any]]) -> None:
+    """Store the cart and push its expiry out again; an empty cart is removed."""
+    conn = _carts_db()
+    now = time.time()
+    if not lines:
+        conn.execute("DELETE FROM carts WHERE id = ?", (cart_id,))
+    else:
+        conn.execute(
+            "INSERT INTO carts (id, lines, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET lines = excluded.lines, expires_at = excluded.expires_at",
+            (cart_id, json.dumps(lines, ensure_ascii=False), now + CART_TTL),
+        )
+    if now - _cart_sweep["last"] >= CART_SWEEP_INTERVAL:
+        _cart_sweep["last"] = now
+        purge_expired_carts()
+
+
+def purge_expired_carts() -> int:
+    conn = _carts_db()
+    now = time.time()
+    conn.execute("DELETE FROM reservations WHERE expires_at <= ?", (now,))
+    cur = conn.execute("DELETE FROM carts WHERE expires_at <= ?", (now,))
+    return cur.rowcount
+
+
+# ----- Stock reservations -----
+# cart_add holds the units it puts in a cart for RESERVATION_TTL seconds, so
+# a buyer who got an item into the cart can still pay for it during a rush.
+# Holds live next to the carts (carts.db) where every worker sees them; a
+# product's available stock is its stock minus what other carts hold.
+#
+# Stock is checked and taken under the products lock (write_transaction),
+# with the sales recorded in the same transaction. The buyer's holds are
+# released before that lock is let go: carts.db commits on its own, but
+# reserve_stock and every other take_stock wait for the same lock, so they
+# never see the lowered stock and the released holds apart.
+RESERVATION_TTL = int(os.environ.get("SHOP_RESERVATION_TTL", str(15 * 60)))
+
+
+def _has_stock(product: Dict[str, Any]) -> bool:
+    # products without an integer stock are not tracked
+    return isinstance(product.get("stock"), int)
+
+
+def reserved_stock(product_ids: Iterable[str], exclude_cart: str | None = None, ahead_only: bool = False) -> Dict[str, int]:
+    """Units held by live reservations per product, not counting ``exclude_cart``'s own.
+
+    With ``ahead_only`` only the holds placed before ``exclude_cart``'s hold on
+    the same product count, so when stock was lowered below what carts hold the
+    oldest holds are still honoured.
+    """
+    wanted = list(set(product_ids))
+    if not wanted:
+        return {}
+    now = time.time()
+    ahead = ""
+    if ahead_only:
+        ahead = (
+            " AND NOT EXISTS (SELECT 1 FROM reservations mine WHERE mine.cart_id = ? AND mine.product_id = r.product_id"
+            " AND mine.expires_at > ? AND mine.rowid < r.rowid)"
+        )
+    rows = _carts_db().execute(
+        f"SELECT product_id, SUM(quantity) FROM reservations r WHERE product_id IN ({', '.join('?' * len(wanted))}) "
+        f"AND expires_at > ? AND cart_id IS NOT ?{ahead} GROUP BY product_id",
+        (*wanted, now, exclude_cart, *((exclude_cart, now) if ahead_only else ())),
+    )
+    return {pid: int(total) for pid, total in rows}
+
+
+def reserve_stock(cart_id: str, product: Dict[str, Any], quantity: int) -> bool:
+    """Hold ``quantity`` more units for the cart; False when that many are not available.
+
+    Every hold of the cart is renewed for another RESERVATION_TTL.
+    """
+    if not _has_stock(product):
+        return True
+    conn = _carts_db()
+    now = time.time()
+    # the products lock keeps take_stock from changing the stock or dropping
+    # holds while this one is checked; IMMEDIATE serialises concurrent holds
+    # on carts.db, so two carts cannot both claim the last units
+    with write_transaction(PRODUCTS_FILE):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            held = reserved_stock([product["id"]], cart_id).get(product["id"], 0)
+            product = get_product(product["id"]) or product
+            if not _has_stock(product):
+                conn.rollback()
+                return True
+            row = conn.execute(
+                "SELECT quantity FROM reservations WHERE cart_id = ? AND product_id = ? AND expires_at > ?",
+                (cart_id, product["id"], now),
+            ).fetchone()
+            mine = (row[0] if row else 0) + quantity
+            if mine > product["stock"] - held:
+                conn.rollback()
+                return False
+            conn.execute(
+                "INSERT INTO reservations (cart_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(cart_id, product_id) DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at",
+                (cart_id, product["id"], mine, now + RESERVATION_TTL),
+            )
+            conn.execute("UPDATE reservations SET expires_at = ? WHERE cart_id = ?", (now + RESERVATION_TTL, cart_id))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    return True
+
+
+def release_stock(cart_id: str, product_ids: Iterable[str] | None = None) -> None:
+    """Drop the cart's holds on ``product_ids``, or all of them."""
+    conn = _carts_db()
+    if product_ids is None:
+        conn.execute("DELETE FROM reservations WHERE cart_id = ?", (cart_id,))
+        return
+    conn.executemany(
+        "DELETE FROM reservations WHERE cart_id = ? AND product_id = ?", [(cart_id, pid) for pid in product_ids]
+    )
+
+
+def take_stock(
+    demand: Dict[str, int], holder: str | None = None, sales: List[Dict[str, Any]] | None = None
+) -> List[str]:
+    """Decrement stock by ``demand`` (product id -> units) as one all-or-nothing change.
+
+    Units held by the ``holder`` cart count as available to it, and those holds
+    are released while the products lock is still held (in carts.db, so not
+    in the same commit as the stock). ``sales`` are recorded in the same
+    transaction as the stock: with SQLite both are one commit, and with JSON
+    files the stock is put back if the sales cannot be written. Returns the
+    names of the products without enough available stock (nothing is changed
+    then); unknown and untracked products are not checked.
+    """
+    with write_transaction(PRODUCTS_FILE, SALES_FILE):
+        tracked = {pid: p for pid, p in get_products_by_id(demand).items() if _has_stock(p)}
+        held = reserved_stock(tracked, holder, ahead_only=holder is not None)
+        short = [p.get("name") for pid, p in tracked.items() if demand[pid] > p["stock"] - held.get(pid, 0)]
+        if short:
+            return short
+        if tracked:
+            save_products([dict(p, stock=p["stock"] - demand[pid]) for pid, p in tracked.items()], event="stock")
+        try:
+            if sales:
+                add_sales(sales)
+        except BaseException:
+            # the JSON stock is already written; with SQLite the rollback
+            # undoes it, and writing it back as well keeps the search index
+            # and change feed in step
+            restock = get_products_by_id(tracked)
+            save_products([dict(p, stock=p["stock"] + demand[pid]) for pid, p in restock.items()], event="stock")
+            raise
+        if holder is not None:
+            release_stock(holder, demand)
+    return []
 
-BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = BASE_DIR / "data"
-USERS_FILE = DATA_DIR / "users.json"
-SALES_FILE = DATA_DIR / "sales.json"
-PRODUCTS_FILE = DATA_DIR / "products.json"
 
+# ----- Change feed -----
+# Product creates, updates, deletes and stock changes are appended to an
+# events table in EVENTS_FILE, a SQLite file of its own so every worker
+# publishes to and reads from the same feed. Browsers poll
+# /api/productos/eventos?format=json for the changes after the last id they
+# saw. Ids only grow, and only the newest EVENTS_KEEP events are kept, so a
+# browser that fell further behind is told to reload.
+#
+# The same URL can also stream the changes as server-sent events (a stream
+# wakes up at once for changes made by its own process and polls for the
+# others'), but a stream holds a request thread for as long as it is open.
+# Streams therefore never take more than a quarter of the threads a worker
+# runs with (serve() records them; SERVE_THREADS otherwise), and
+# SHOP_EVENT_STREAMS can lower that cap, down to 0 to turn streams off. Once
+# every slot is taken the endpoint answers 204 and the page polls instead.
+EVENTS_KEEP = 10_000
+EVENT_POLL_INTERVAL = 1.0
+EVENT_HEARTBEAT = 15.0
+EVENT_RETRY_MS = 3000
+# how often pages poll for changes when they are not streaming
+EVENT_CLIENT_POLL_MS = 5000
+# None: a quarter of the request threads
+EVENT_STREAMS = int(os.environ["SHOP_EVENT_STREAMS"]) if os.environ.get("SHOP_EVENT_STREAMS") else None
+# streams end after this long and the browser reconnects, so an open tab
+# does not hold a server thread forever
+EVENT_STREAM_SECONDS = float(os.environ.get("SHOP_EVENT_STREAM_SECONDS", "300"))
+_events_local = threading.local()
+_events_cond = threading.Condition()
+_events_seq = {"value": 0}
+# "threads": request threads per worker, set by serve()
+_event_streams: Dict[str, Any] = {"open": 0, "threads": None}
 
-def load_json(file_path: Path) -> Dict[str, Any]:
-    if not file_path.exists():
-        return {}
-    with file_path.open("r", encoding="utf-8") as file:
-        return json.load(file)
 
+def _events_db() -> sqlite3.Connection:
+    conn = getattr(_events_local, "conn", None)
+    if conn is None:
+        EVENTS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(EVENTS_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # AUTOINCREMENT: ids of pruned events are never handed out again
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        _events_local.conn = conn
+    return conn
 
-def save_json(file_path: Path, payload: Dict[str, Any]) -> None:
-    file_path.parent.mkdir(parents=True, exist_ok=True)
-    with file_path.open("w", encoding="utf-8") as file:
-        json.dump(payload, file, indent=2, ensure_ascii=False)
 
+def _product_event(kind: str, product: Dict[str, Any]) -> Dict[str, Any]:
+    if kind == "stock":
+        return {"id": product.get("id"), "stock": product.get("stock")}
+    return {key: product.get(key) for key in ("id", "name", "sku", "price", "stock")}
 
-def get_users() -> List[Dict[str, Any]]:
-    data = load_json(USERS_FILE)
-    return data.get("users", [])
 
+def publish_events(events: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """Append (kind, data) events to the change feed and wake the local streams."""
+    if not events:
+        return
+    conn = _events_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO events (kind, data) VALUES (?, ?)",
+            [(kind, json.dumps(data, ensure_ascii=False)) for kind, data in events],
+        )
+        last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()[0]
+        # prune whenever the ids cross a multiple of 500
+        if last % 500 < len(events):
+            conn.execute("DELETE FROM events WHERE id <= ?", (last - EVENTS_KEEP,))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    with _events_cond:
+        _events_seq["value"] += 1
+        _events_cond.notify_all()
 
-def get_sales() -> List[Dict[str, Any]]:
-    data = load_json(SALES_FILE)
-    return data.get("sales", [])
 
+def latest_event_id() -> int:
+    row = _events_db().execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+    return row[0] if row else 0
 
-def get_products() -> List[Dict[str, Any]]:
-    data = load_json(PRODUCTS_FILE)
-    return data.get("products", [])
 
+def events_after(last_id: int, limit: int = 500) -> List[Tuple[int, str, str]] | None:
+    """Events newer than ``last_id`` as (id, kind, JSON data); None when some were already pruned."""
+    conn = _events_db()
+    rows = conn.execute("SELECT id, kind, data FROM events WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)).fetchall()
+    if rows and rows[0][0] > last_id + 1:
+        # ids are contiguous, so a hole right after last_id means pruning
+        oldest = conn.execute("SELECT MIN(id) FROM events").fetchone()[0]
+        if oldest > last_id + 1:
+            return None
+    return rows
 
-def persist_products(products: List[Dict[str, Any]]) -> None:
-    save_json(PRODUCTS_FILE, {"products": products})
 
+def event_stream_slots() -> int:
+    """How many streams this process may hold open at once."""
+    quarter = (_event_streams["threads"] or SERVE_THREADS) // 4
+    return quarter if EVENT_STREAMS is None else max(0, min(EVENT_STREAMS, quarter))
 
-def persist_sales(sales: List[Dict[str, Any]]) -> None:
-    save_json(SALES_FILE, {"sales": sales})
 
+def open_event_stream() -> bool:
+    """Take a stream slot; False when they are all in use. Give it back with close_event_stream."""
+    with _events_cond:
+        if _event_streams["open"] >= event_stream_slots():
+            return False
+        _event_streams["open"] += 1
+        return True
+
+
+def close_event_stream() -> None:
+    with _events_cond:
+        _event_streams["open"] -= 1
+
+
+def event_stream(last_id: int) -> Iterator[str]:
+    """Server-sent event lines for every change after ``last_id``."""
+    yield f"retry: {EVENT_RETRY_MS}\n\n"
+    started = quiet_since = time.monotonic()
+    while time.monotonic() - started < EVENT_STREAM_SECONDS:
+        seen = _events_seq["value"]
+        events = events_after(last_id)
+        if events is None:
+            yield "event: reset\ndata: {}\n\n"
+            return
+        for event_id, kind, data in events:
+            last_id = event_id
+            yield f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+        if events:
+            quiet_since = time.monotonic()
+            continue
+        if time.monotonic() - quiet_since >= EVENT_HEARTBEAT:
+            # keeps proxies from closing an idle connection
+            yield ": ping\n\n"
+            quiet_since = time.monotonic()
+        with _events_cond:
+            _events_cond.wait_for(lambda: _events_seq["value"] != seen, EVENT_POLL_INTERVAL)
+
+
+# ----- Production server -----
+# `flask --app app serve` (and `python app.py`) run the app under gunicorn
+# with threaded workers when it is installed, and otherwise on a small
+# built-in prefork server: the parent binds the socket and forks
+# SERVE_WORKERS children, each answering from a pool of SERVE_THREADS
+# threads. Without os.fork (Windows) waitress, or else werkzeug's threaded
+# server, runs a single process. Data files are loaded and the derived
+# caches built before forking, and gc.freeze() keeps the collector from
+# writing to them, so the workers share those pages copy-on-write. SIGTERM
+# or SIGINT stop accepting connections and give in-flight requests up to
+# GRACEFUL_TIMEOUT seconds to finish.
+SERVE_HOST = os.environ.get("SHOP_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SHOP_PORT", "5000"))
+SERVE_WORKERS = int(os.environ.get("SHOP_WORKERS", str(os.cpu_count() or 1)))
+SERVE_THREADS = int(os.environ.get("SHOP_THREADS", "8"))
+GRACEFUL_TIMEOUT = float(os.environ.get("SHOP_GRACEFUL_TIMEOUT", "30"))
+
+
+def warm_caches() -> Dict[str, int]:
+    """Read every data file and build the caches derived from them; returns the records read."""
+    counts = {
+        "usuarios": len(get_users()),
+        "productos": sum(1 for _ in iter_products()),
+        "ventas": sum(1 for _ in iter_sales()),
+    }
+    catalog_version()
+    sales_version()
+    _current_search_index()
+    sales_aggregates()
+    _asset("css/styles.css")
+    return counts
+
+
+def close_connections() -> None:
+    """Close this thread's SQLite connections; a forked worker must open its own."""
+    for local in (_db_local, _carts_local, _events_local, _metrics_local):
+        conn = getattr(local, "conn", None)
+        if conn is not None:
+            conn.close()
+            local.conn = None
 
-def find_user(username: str) -> Dict[str, Any] | None:
-    for user in get_users():
-        if user.get("username") == username:
-            return user
-    return None
+
+class _RequestHandler(WSGIRequestHandler):
+    # one request per connection: an idle keep-alive connection would
+    # otherwise hold one of the few pool threads
+    protocol_version = "HTTP/1.0"
+
+
+class _PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server answering from a fixed pool of threads.
+
+    Once every thread is busy the process stops accepting, so the other
+    workers on the same socket take the next connections.
+    """
+
+    multithread = True
+
+    def __init__(self, host: str, port: int, app: Any, threads: int, fd: int | None = None) -> None:
+        self.slots = threading.BoundedSemaphore(threads)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="request")
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        self.slots.acquire()
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request: Any, client_address: Any) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def _prefork_worker(app: Any, listener: socket.socket, host: str, port: int, threads: int) -> None:
+    # forked workers would otherwise all draw the same random numbers
+    random.seed()
+    server = _PooledWSGIServer(host, port, app, threads, fd=listener.fileno())
+    parent = os.getppid()
+
+    def stop(signum: int, frame: Any) -> None:
+        # shutdown() waits for serve_forever to return, so it cannot run on its thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def watch_parent() -> None:
+        # a worker whose parent died would otherwise keep serving on the port
+        while os.getppid() == parent:
+            time.sleep(1)
+        stop(signal.SIGTERM, None)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    threading.Thread(target=watch_parent, daemon=True).start()
+    server.serve_forever()
+    # let the requests already accepted finish, for up to GRACEFUL_TIMEOUT:
+    # every slot is free again once none is in flight. The caller then ends
+    # the process with os._exit, which does not wait for the pool's threads.
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    for _ in range(threads):
+        if not server.slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            break
+    server.pool.shutdown(wait=False)
+
+
+def _serve_prefork(app: Any, host: str, port: int, workers: int, threads: int) -> None:
+    # the address family follows the host, so "::1" or "::" work too; "::"
+    # also takes IPv4 connections where the system allows it
+    family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+    listener = socket.create_server(
+        (host, port),
+        family=family,
+        backlog=1024,
+        dualstack_ipv6=host == "::" and socket.has_dualstack_ipv6(),
+    )
+    children: set[int] = set()
+    stopping = threading.Event()
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _prefork_worker(app, listener, host, port, threads)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum: int, frame: Any) -> None:
+        stopping.set()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    address = f"[{host}]" if family == socket.AF_INET6 else host
+    click.echo(f"Escuchando en http://{address}:{port} con {workers} procesos de {threads} hilos")
+    while children and not stopping.is_set():
+        # polled rather than os.wait(), which a signal does not interrupt
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            time.sleep(0.1)
+            continue
+        children.discard(pid)
+        if not stopping.is_set():
+            click.echo(f"El proceso {pid} terminó inesperadamente (estado {status}); se reemplaza", err=True)
+            time.sleep(1)
+            spawn()
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    while children:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            children.discard(pid)
+        elif time.monotonic() > deadline:
+            for pid in children:
+                os.kill(pid, signal.SIGKILL)
+            deadline = float("inf")
+        else:
+            time.sleep(0.05)
+    listener.close()
+
+
+def _serve_gunicorn(app: Any, host: str, port: int, workers: int, threads: int) -> None:
+    options = {
+        # gunicorn reads an IPv6 address in brackets
+        "bind": f"[{host}]:{port}" if ":" in host else f"{host}:{port}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "preload_app": True,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+    }
+
+    class Server(GunicornApplication):
+        def load_config(self) -> None:
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self) -> Any:
+            return app
+
+    Server().run()
+
+
+def serve(
+    app: Flask,
+    host: str = SERVE_HOST,
+    port: int = SERVE_PORT,
+    workers: int = SERVE_WORKERS,
+    threads: int = SERVE_THREADS,
+) -> None:
+    """Warm the caches and run ``app`` under the best server available until stopped."""
+    started = time.perf_counter()
+    _event_streams["threads"] = threads
+    counts = warm_caches()
+    close_connections()
+    # everything loaded so far is left alone by the collector from now on
+    gc.freeze()
+    loaded = ", ".join(f"{n} {name}" for name, n in counts.items())
+    click.echo(f"Datos cargados en {time.perf_counter() - started:.2f}s ({loaded})")
+    if hasattr(os, "fork"):
+        if GunicornApplication is not None:
+            _serve_gunicorn(app, host, port, workers, threads)
+        else:
+            _serve_prefork(app, host, port, workers, threads)
+    elif waitress is not None:
+        waitress.serve(app, host=host, port=port, threads=threads)
+    else:
+        run_simple(host, port, app, threaded=True)
 
 
 def require_login() -> bool:
@@ -82,9 +3227,87 @@ def is_admin() -> bool:
 def create_app() -> Flask:
     app = Flask(__name__)
     app.config["SECRET_KEY"] = "change-this-secret-key"
+    migrate_data()
+    number_products()
+
+    # ----- Request metrics -----
+    @app.before_request
+    def start_request_timer() -> None:
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response: Response) -> Response:
+        start_metrics_flusher()
+        started = g.pop("request_started", None)
+        if started is not None:
+            # streamed bodies (CSV report) are produced after this point and
+            # are not included
+            observe(
+                "shop_request_seconds",
+                time.perf_counter() - started,
+                endpoint=request.endpoint or "unmatched",
+                method=request.method,
+                status=str(response.status_code),
+            )
+        return response
+
+    def _template_started(sender: Flask, template: Any, context: Dict[str, Any], **extra: Any) -> None:
+        g.setdefault("template_starts", []).append(time.perf_counter())
+
+    def _template_finished(sender: Flask, template: Any, context: Dict[str, Any], **extra: Any) -> None:
+        starts = g.get("template_starts")
+        if starts:
+            observe("shop_template_seconds", time.perf_counter() - starts.pop(), template=template.name or "")
+
+    # blinker keeps weak references by default, which would drop these closures
+    before_render_template.connect(_template_started, app, weak=False)
+    template_rendered.connect(_template_finished, app, weak=False)
+
+    # the event stream is long-lived and the profile pages would only profile themselves
+    unprofiled = {"static", "asset", "api_products_events", "profiles_list", "profile_detail", "profile_download"}
+
+    @app.before_request
+    def start_request_profile() -> None:
+        if request.endpoint in unprofiled:
+            return
+        asked = request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1"
+        if (asked and is_admin()) or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+            g.profiler = start_profile()
+            g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def save_request_profile(response: Response) -> Response:
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        stop_profile(profiler)
+        profile_id = save_profile(
+            profiler,
+            {
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "endpoint": request.endpoint or "unmatched",
+                "status": response.status_code,
+                "seconds": round(time.perf_counter() - g.pop("profile_started"), 6),
+                "user": session.get("username"),
+            },
+        )
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    @app.teardown_request
+    def discard_request_profile(exc: BaseException | None) -> None:
+        # after_request is skipped when the view raised
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            stop_profile(profiler)
 
     @app.before_request
     def ensure_data_files() -> None:
+        if STORAGE_BACKEND == "sqlite":
+            if _db().execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                add_user({"username": "admin", "password": "admin123", "name": "Administrador"})
+            return
         if not USERS_FILE.exists():
             save_json(
                 USERS_FILE,
@@ -98,8 +3321,9 @@ def create_app() -> Flask:
                     ]
                 },
             )
-        if not SALES_FILE.exists():
-            save_json(SALES_FILE, {"sales": []})
+        # monthly shards are created as sales arrive
+        if SALES_STORAGE != "monthly" and not SALES_FILE.exists():
+            save_json(SALES_FILE, _sales_payload([]))
         if not PRODUCTS_FILE.exists():
             save_json(PRODUCTS_FILE, {"products": []})
 
@@ -143,25 +3367,42 @@ def create_app() -> Flask:
         flash("Has cerrado sesión.", "info")
         return redirect(url_for("login"))
 
-    # ----- Cart helpers (stored in cookies) -----
-    def _get_cart() -> List[Dict[str, Any]]:
+    # ----- Cart helpers (server-side store, id in a cookie) -----
+    def _get_cart() -> Dict[str, Dict[str, Any]]:
         raw = request.cookies.get("cart")
         if not raw:
-            return []
+            return {}
+        if is_cart_id(raw):
+            return load_cart(raw)
+        # carts from before the server-side store kept every line in the cookie
         try:
             data = json.loads(raw)
-            if isinstance(data, list):
-                return data
         except Exception:
-            return []
-        return []
+            return {}
+        if not isinstance(data, list):
+            return {}
+        return {str(line.get("product_id")): line for line in data if isinstance(line, dict)}
+
+    def _cart_id() -> str:
+        # a new cart gets its id on first use; _set_cart then sends the cookie
+        if "cart_id" not in g:
+            raw = request.cookies.get("cart")
+            g.cart_id = raw if is_cart_id(raw) else new_cart_id()
+        return g.cart_id
+
+    def _set_cart(response, cart: Dict[str, Dict[str, Any]]) -> None:
+        cart_id = _cart_id()
+        save_cart(cart_id, cart)
+        if cart:
+            response.set_cookie("cart", cart_id, max_age=CART_TTL, httponly=True, samesite="Lax")
+        else:
+            response.delete_cookie("cart")
 
-    def _set_cart(response, cart: List[Dict[str, Any]]) -> None:
+    def _page_size() -> int:
         try:
-            response.set_cookie("cart", json.dumps(cart), max_age=60 * 60 * 24 * 30)
-        except Exception:
-            # if cookie too large or other error, ignore silently
-            pass
+            return max(1, min(int(request.args.get("per_page", PAGE_SIZE)), MAX_PAGE_SIZE))
+        except ValueError:
+            return PAGE_SIZE
 
     # ----- User registration (buyer) -----
     @app.route("/register", methods=["GET", "POST"])
@@ -179,9 +3420,7 @@ def create_app() -> Flask:
             if find_user(username):
                 flash("El usuario ya existe.", "error")
                 return render_template("register.html")
-            users = get_users()
-            users.append({"username": username, "password": password, "name": name, "email": email, "phone": phone})
-            save_json(USERS_FILE, {"users": users})
+            add_user({"username": username, "password": password, "name": name, "email": email, "phone": phone})
             flash("Usuario registrado. Puedes iniciar sesión.", "success")
             return redirect(url_for("login"))
         return render_template("register.html")
@@ -197,7 +3436,7 @@ def create_app() -> Flask:
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
         cart = _get_cart()
-        return render_template("cart.html", cart=cart)
+        return render_template("cart.html", cart=list(cart.values()), reservation_minutes=RESERVATION_TTL // 60)
 
     @app.route("/carrito/agregar", methods=["POST"])
     def cart_add():
@@ -217,22 +3456,25 @@ def create_app() -> Flask:
                 qty_value = 1
         except Exception:
             qty_value = 1
-        prod = next((p for p in get_products() if p.get("id") == product_id), None)
+        prod = get_product(product_id)
         if not prod:
             flash("Producto no encontrado.", "error")
             return redirect(url_for("products_list"))
+        if not reserve_stock(_cart_id(), prod, qty_value):
+            flash(f"No hay stock suficiente de {prod.get('name')}.", "error")
+            return redirect(url_for("products_list"))
         cart = _get_cart()
         # if exists, increment
-        existing = next((c for c in cart if c.get("product_id") == product_id), None)
+        existing = cart.get(product_id)
         if existing:
             existing["quantity"] = existing.get("quantity", 0) + qty_value
         else:
-            cart.append({
+            cart[product_id] = {
                 "product_id": product_id,
                 "name": prod.get("name"),
                 "price": prod.get("price", 0),
                 "quantity": qty_value,
-            })
+            }
         resp = make_response(redirect(url_for("cart_view")))
         _set_cart(resp, cart)
         flash("Producto agregado al carrito.", "success")
@@ -248,9 +3490,10 @@ def create_app() -> Flask:
             return redirect(url_for("products_list"))
         product_id = request.form.get("product_id", "").strip()
         cart = _get_cart()
-        new_cart = [c for c in cart if c.get("product_id") != product_id]
+        cart.pop(product_id, None)
+        release_stock(_cart_id(), [product_id])
         resp = make_response(redirect(url_for("cart_view")))
-        _set_cart(resp, new_cart)
+        _set_cart(resp, cart)
         flash("Artículo eliminado.", "info")
         return resp
 
@@ -267,38 +3510,43 @@ def create_app() -> Flask:
         if not cart:
             flash("El carrito está vacío.", "error")
             return redirect(url_for("cart_view"))
-        sales = get_sales()
-        for item in cart:
+        lines = []
+        for item in cart.values():
             try:
                 quantity = int(item.get("quantity", 0))
                 price = float(item.get("price", 0))
             except Exception:
                 continue
-            sale = {
+            lines.append((item, quantity, price))
+        demand: Dict[str, int] = {}
+        for item, quantity, _ in lines:
+            demand[item.get("product_id")] = demand.get(item.get("product_id"), 0) + quantity
+
+        customer = {"name": session.get("display_name"), "email": session.get("email", ""), "phone": session.get("phone", "")}
+        created_at = utc_now()
+        new_sales = [
+            {
                 "id": str(uuid4()),
                 "product": item.get("name"),
                 "product_id": item.get("product_id"),
                 "quantity": quantity,
                 "price": price,
-                "customer": {"name": session.get("display_name"), "email": session.get("email", ""), "phone": session.get("phone", "")},
+                "customer": dict(customer),
                 "seller": session.get("display_name"),
+                "created_at": created_at,
             }
-            sales.append(sale)
-            # decrement stock if product exists
-            products = get_products()
-            prod = next((p for p in products if p.get("id") == item.get("product_id")), None)
-            if prod and isinstance(prod.get("stock"), int):
-                try:
-                    prod_stock = int(prod.get("stock", 0))
-                    prod["stock"] = max(0, prod_stock - quantity)
-                except Exception:
-                    pass
-            persist_products(products)
-        persist_sales(sales)
+            for item, quantity, price in lines
+        ]
+        # the whole cart's stock is taken at once (using the cart's holds)
+        # together with writing its sales
+        short = take_stock(demand, holder=_cart_id(), sales=new_sales)
+        if short:
+            flash(f"Stock insuficiente para: {', '.join(short)}.", "error")
+            return redirect(url_for("cart_view"))
         # after checkout redirect buyers to the tienda
         resp = make_response(redirect(url_for("products_list")))
         # clear cart
-        _set_cart(resp, [])
+        _set_cart(resp, {})
         flash("Compra realizada correctamente.", "success")
         return resp
 
@@ -308,23 +3556,23 @@ def create_app() -> Flask:
         if not require_login() or not is_admin():
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
-        sales = get_sales()
-        # Normalize customer field: allow older sales where customer is a string
-        for s in sales:
-            cust = s.get("customer")
-            if cust is None:
-                s["customer"] = {"name": "", "email": "", "phone": ""}
-            elif isinstance(cust, str):
-                s["customer"] = {"name": cust, "email": "", "phone": ""}
-            else:
-                # ensure all keys exist
-                s["customer"] = {
-                    "name": cust.get("name", "") if isinstance(cust, dict) else str(cust),
-                    "email": cust.get("email", "") if isinstance(cust, dict) else "",
-                    "phone": cust.get("phone", "") if isinstance(cust, dict) else "",
-                }
-
-        return render_template("sales_list.html", sales=sales)
+        filters = {
+            k: request.args.get(k, "").strip()
+            for k in ("product", "customer", "seller", "price_min", "price_max", "date_from", "date_to")
+        }
+        sort = request.args.get("sort", "")
+        # read before the query so cached rows are never newer than their key
+        version = sales_version()
+        sales, next_cursor = query_sales(filters, sort, request.args.get("cursor"), _page_size())
+        return render_template(
+            "sales_list.html",
+            sales=sales,
+            data_version=version,
+            filters={k: v for k, v in filters.items() if v},
+            sort=sort,
+            next_cursor=next_cursor,
+            paged=bool(request.args.get("cursor")),
+        )
 
     @app.route("/ventas/nueva", methods=["GET", "POST"])
     def sales_create():
@@ -333,8 +3581,6 @@ def create_app() -> Flask:
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
 
-        products = get_products()
-
         if request.method == "POST":
             product = request.form.get("product", "").strip()
             # allow selecting a product from inventory
@@ -348,29 +3594,29 @@ def create_app() -> Flask:
 
             # if product selected from inventory, override name/price BEFORE validation
             if product_id:
-                prod = next((p for p in products if p.get("id") == product_id), None)
+                prod = get_product(product_id)
                 if prod:
                     product = prod.get("name", product)
                     # if price not provided, use product price
                     if not price:
                         price = str(prod.get("price", ""))
 
-            errors = []
-            if not product:
-                errors.append("El producto es obligatorio.")
-            if not quantity or not quantity.isdigit():
-                errors.append("La cantidad debe ser un número entero.")
-            if not price:
-                errors.append("El precio es obligatorio.")
-
-            try:
-                price_value = float(price)
-                if price_value < 0:
-                    errors.append("El precio debe ser positivo.")
-            except ValueError:
-                errors.append("El precio debe ser numérico.")
-
-            quantity_value = int(quantity) if quantity.isdigit() else 0
+            quantity_value, price_value, errors = validate_sale_fields(product, quantity, price)
+            new_sale = {
+                "id": str(uuid4()),
+                "product": product,
+                "product_id": product_id,
+                "quantity": quantity_value,
+                "price": price_value,
+                "customer": {"name": customer_name, "email": customer_email, "phone": customer_phone},
+                "seller": session.get("display_name"),
+                "created_at": utc_now(),
+            }
+            # the stock is taken and the sale recorded in one write; units
+            # held by carts are not available to manual sales
+            demand = {product_id: quantity_value} if product_id else {}
+            if not errors and take_stock(demand, sales=[new_sale]):
+                errors.append("Stock insuficiente para el producto seleccionado.")
 
             if errors:
                 for error in errors:
@@ -385,37 +3631,11 @@ def create_app() -> Flask:
                         "price": price,
                         "customer": {"name": customer_name, "email": customer_email, "phone": customer_phone},
                     },
-                    products=products,
                 )
 
-            new_sale = {
-                "id": str(uuid4()),
-                "product": product,
-                "product_id": product_id,
-                "quantity": quantity_value,
-                "price": price_value,
-                "customer": {"name": customer_name, "email": customer_email, "phone": customer_phone},
-                "seller": session.get("display_name"),
-            }
-            sales = get_sales()
-            sales.append(new_sale)
-            persist_sales(sales)
-            # decrement stock if product used
-            if product_id:
-                prod = next((p for p in products if p.get("id") == product_id), None)
-                if prod and isinstance(prod.get("stock"), int):
-                    try:
-                        prod_stock = int(prod.get("stock", 0))
-                        if quantity_value > prod_stock:
-                            flash("Stock insuficiente para el producto seleccionado.", "error")
-                            return redirect(url_for("sales_create"))
-                        prod["stock"] = prod_stock - quantity_value
-                        persist_products(products)
-                    except Exception:
-                        pass
             flash("Venta creada correctamente.", "success")
             return redirect(url_for("sales_list"))
-        return render_template("sales_form.html", action="Crear", sale=None, products=products)
+        return render_template("sales_form.html", action="Crear", sale=None)
 
     @app.route("/ventas/<sale_id>/editar", methods=["GET", "POST"])
     def sales_edit(sale_id: str):
@@ -423,26 +3643,10 @@ def create_app() -> Flask:
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
 
-        sales = get_sales()
-        sale = next((item for item in sales if item["id"] == sale_id), None)
+        sale = get_sale(sale_id)
         if sale is None:
             abort(404, description="Venta no encontrada")
 
-        # Normalize existing sale customer to dict for editing
-        cust = sale.get("customer")
-        if cust is None:
-            sale["customer"] = {"name": "", "email": "", "phone": ""}
-        elif isinstance(cust, str):
-            sale["customer"] = {"name": cust, "email": "", "phone": ""}
-        else:
-            sale["customer"] = {
-                "name": cust.get("name", "") if isinstance(cust, dict) else str(cust),
-                "email": cust.get("email", "") if isinstance(cust, dict) else "",
-                "phone": cust.get("phone", "") if isinstance(cust, dict) else "",
-            }
-
-        products = get_products()
-
         if request.method == "POST":
             product = request.form.get("product", "").strip()
             product_id = request.form.get("product_id", "").strip()
@@ -454,28 +3658,13 @@ def create_app() -> Flask:
 
             # if product selected from inventory, override name/price BEFORE validation
             if product_id:
-                prod = next((p for p in products if p.get("id") == product_id), None)
+                prod = get_product(product_id)
                 if prod:
                     product = prod.get("name", product)
                     if not price:
                         price = str(prod.get("price", ""))
 
-            errors = []
-            if not product:
-                errors.append("El producto es obligatorio.")
-            if not quantity or not quantity.isdigit():
-                errors.append("La cantidad debe ser un número entero.")
-            if not price:
-                errors.append("El precio es obligatorio.")
-
-            try:
-                price_value = float(price)
-                if price_value < 0:
-                    errors.append("El precio debe ser positivo.")
-            except ValueError:
-                errors.append("El precio debe ser numérico.")
-
-            quantity_value = int(quantity) if quantity.isdigit() else sale["quantity"]
+            quantity_value, price_value, errors = validate_sale_fields(product, quantity, price)
 
             if errors:
                 for error in errors:
@@ -491,7 +3680,6 @@ def create_app() -> Flask:
                         "price": price,
                         "customer": {"name": customer_name, "email": customer_email, "phone": customer_phone},
                     },
-                    products=products,
                 )
 
             sale.update(
@@ -503,11 +3691,11 @@ def create_app() -> Flask:
                     "customer": {"name": customer_name, "email": customer_email, "phone": customer_phone},
                 }
             )
-            persist_sales(sales)
+            update_sale(sale)
             flash("Venta actualizada.", "success")
             return redirect(url_for("sales_list"))
 
-        return render_template("sales_form.html", action="Editar", sale=sale, products=products)
+        return render_template("sales_form.html", action="Editar", sale=sale)
 
     @app.route("/ventas/<sale_id>/eliminar", methods=["POST"])
     def sales_delete(sale_id: str):
@@ -515,109 +3703,358 @@ def create_app() -> Flask:
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
 
-        sales = get_sales()
-        new_sales = [sale for sale in sales if sale["id"] != sale_id]
-        if len(new_sales) == len(sales):
+        if not delete_sale(sale_id):
             abort(404, description="Venta no encontrada")
 
-        persist_sales(new_sales)
         flash("Venta eliminada.", "info")
         return redirect(url_for("sales_list"))
 
+    @app.route("/ventas/lote", methods=["POST"])
+    def sales_bulk():
+        """Eliminar, cambiar el precio o reasignar el vendedor de varias ventas con una sola escritura."""
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+
+        ids = [i for i in request.form.getlist("ids") if i]
+        action = request.form.get("action", "")
+        if not ids:
+            flash("Selecciona al menos una venta.", "error")
+        elif action == "delete":
+            flash(f"Ventas eliminadas: {delete_sales(ids)}.", "info")
+        elif action == "price":
+            try:
+                price = float(request.form.get("price", "").strip())
+            except ValueError:
+                price = -1.0
+            if price < 0:
+                flash("El precio debe ser un número positivo.", "error")
+            else:
+                flash(f"Precio actualizado en {edit_sales(ids, {'price': price})} ventas.", "success")
+        elif action == "seller":
+            seller = request.form.get("seller", "").strip()
+            if not seller:
+                flash("Indica el nuevo vendedor.", "error")
+            else:
+                flash(f"Vendedor reasignado en {edit_sales(ids, {'seller': seller})} ventas.", "success")
+        else:
+            flash("Acción no válida.", "error")
+        return redirect(url_for("sales_list"))
+
+    def _date_filters() -> Dict[str, str]:
+        return {k: request.args.get(k, "").strip() for k in ("date_from", "date_to") if request.args.get(k, "").strip()}
+
+    def _report_job_json(job: Dict[str, Any]) -> Dict[str, Any]:
+        done = job["status"] == "done"
+        dates = _date_filters()
+        return {
+            "id": job["id"],
+            "status": job["status"],
+            "error": job["error"],
+            "status_url": url_for("sales_report_status", job_id=job["id"], **dates),
+            "download_url": url_for("sales_report_download", job_id=job["id"], **dates) if done else None,
+        }
+
+    def _wants_json() -> bool:
+        return request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json"
+
     @app.route("/ventas/reporte")
     def sales_report():
-        """Genera un CSV con todas las ventas y el inventario y lo devuelve como descarga."""
+        """Excel con todas las ventas y el inventario (o CSV con ?format=csv).
+
+        ``date_from``/``date_to`` (AAAA-MM-DD) limitan las ventas a ese rango.
+
+        El Excel se genera en segundo plano: si ya existe para los datos
+        actuales se descarga directamente; si no, se devuelve el trabajo para
+        consultar su estado y descargarlo al terminar.
+        """
         if not require_login() or not is_admin():
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
 
-        sales = get_sales()
-
-        # Normalize customer info
-        for s in sales:
-            cust = s.get("customer")
-            if cust is None:
-                s["customer"] = {"name": "", "email": "", "phone": ""}
-            elif isinstance(cust, str):
-                s["customer"] = {"name": cust, "email": "", "phone": ""}
-            else:
-                s["customer"] = {
-                    "name": cust.get("name", "") if isinstance(cust, dict) else str(cust),
-                    "email": cust.get("email", "") if isinstance(cust, dict) else "",
-                    "phone": cust.get("phone", "") if isinstance(cust, dict) else "",
-                }
+        if request.args.get("format") == "csv":
+            return _sales_report_csv()
 
-        # Produce an Excel (.xlsx) file with two sheets: Sales and Inventory.
         # openpyxl is required. If missing, inform the admin and redirect back.
         try:
-            from openpyxl import Workbook
+            import openpyxl  # noqa: F401
         except Exception:
             flash("No se puede generar el reporte: falta la librería 'openpyxl'. Instala con: pip install openpyxl", "error")
             return redirect(url_for("sales_list"))
 
-        wb = Workbook()
-        ws_sales = wb.active
-        ws_sales.title = "Sales"
-
-        sales_header = [
-            "id",
-            "product",
-            "quantity",
-            "price",
-            "seller",
-            "customer_name",
-            "customer_email",
-            "customer_phone",
-            "total",
-        ]
-        ws_sales.append(sales_header)
-
-        for s in sales:
-            cust = s.get("customer", {}) or {}
-            qty = s.get("quantity", 0)
-            price = s.get("price", 0)
-            total = qty * price if isinstance(qty, (int, float)) and isinstance(price, (int, float)) else ""
-            ws_sales.append([
-                s.get("id", ""),
-                s.get("product", ""),
-                qty,
-                price,
-                s.get("seller", ""),
-                cust.get("name", ""),
-                cust.get("email", ""),
-                cust.get("phone", ""),
-                total,
-            ])
-
-        # Inventory sheet
-        ws_inv = wb.create_sheet(title="Inventory")
-        inv_header = ["inventory_id", "name", "sku", "price", "stock"]
-        ws_inv.append(inv_header)
-        products = get_products()
-        for p in products:
-            ws_inv.append([
-                p.get("id", ""),
-                p.get("name", ""),
-                p.get("sku", ""),
-                p.get("price", ""),
-                p.get("stock", ""),
-            ])
-
-        bio = io.BytesIO()
-        wb.save(bio)
-        bio.seek(0)
-        resp = Response(bio.getvalue(), mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-        resp.headers["Content-Disposition"] = "attachment; filename=reporte_ventas_e_inventario.xlsx"
+        job = submit_sales_report(*date_bounds(request.args.get("date_from"), request.args.get("date_to")))
+        if _wants_json():
+            return jsonify(_report_job_json(job)), 200 if job["status"] == "done" else 202
+        if job["status"] == "done":
+            return sales_report_download(job["id"])
+        return render_template("report_job.html", job=_report_job_json(job))
+
+    @app.route("/ventas/reporte/<job_id>")
+    def sales_report_status(job_id: str):
+        if not require_login() or not is_admin():
+            return jsonify({"error": "admin required"}), 403
+        job = report_job(job_id, *date_bounds(request.args.get("date_from"), request.args.get("date_to")))
+        if job is None:
+            return jsonify({"error": "unknown job"}), 404
+        return jsonify(_report_job_json(job))
+
+    @app.route("/ventas/reporte/<job_id>/descargar")
+    def sales_report_download(job_id: str):
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+        if not _REPORT_ID.match(job_id):
+            abort(404)
+        try:
+            # opened before sending so a concurrent prune cannot remove it mid-download
+            report = report_path(job_id).open("rb")
+        except FileNotFoundError:
+            job = report_job(job_id, *date_bounds(request.args.get("date_from"), request.args.get("date_to")))
+            if job is None:
+                abort(404, description="Reporte no encontrado")
+            return redirect(url_for("sales_report", **_date_filters()))
+        return send_file(
+            report,
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            as_attachment=True,
+            download_name="reporte_ventas_e_inventario.xlsx",
+        )
+
+    def _sales_report_csv() -> Response:
+        bounds = date_bounds(request.args.get("date_from"), request.args.get("date_to"))
+
+        def generate() -> Iterator[str]:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            # BOM so Excel opens the accents correctly
+            buffer.write("\ufeff")
+            writer.writerow(SALES_REPORT_HEADER)
+            for row in _sales_report_rows(*bounds):
+                writer.writerow(row)
+                if buffer.tell() >= 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        resp = Response(stream_with_context(generate()), mimetype="text/csv")
+        resp.headers["Content-Disposition"] = "attachment; filename=reporte_ventas.csv"
+        return resp
+
+    @app.route("/ventas/resumen")
+    def sales_summary():
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+        dates = _date_filters()
+        aggregates = sales_aggregates_between(*date_bounds(dates.get("date_from"), dates.get("date_to")))
+        ranked = {
+            dimension: sorted(entries.items(), key=lambda item: item[1]["revenue"], reverse=True)
+            for dimension, entries in aggregates.items()
+        }
+        return render_template("sales_summary.html", aggregates=ranked, filters=dates)
+
+    @app.route("/ventas/resumen.json")
+    def sales_summary_json():
+        if not require_login() or not is_admin():
+            abort(403)
+        dimension = request.args.get("dimension")
+        key = request.args.get("key")
+        lower, upper = date_bounds(request.args.get("date_from"), request.args.get("date_to"))
+        if lower is not None or upper is not None:
+            aggregates = sales_aggregates_between(lower, upper)
+            if dimension is None:
+                return jsonify(aggregates)
+            if dimension not in aggregates:
+                abort(404)
+            if key is None:
+                return jsonify(aggregates[dimension])
+            if key not in aggregates[dimension]:
+                abort(404)
+            return jsonify(aggregates[dimension][key])
+        if dimension is not None and key is not None:
+            entry = sales_aggregate(dimension, key)
+            if entry is None:
+                abort(404)
+            return jsonify(entry)
+        aggregates = sales_aggregates()
+        if dimension is not None:
+            if dimension not in aggregates:
+                abort(404)
+            return jsonify(aggregates[dimension])
+        return jsonify(aggregates)
+
+    # ----- Catalog JSON API -----
+    # Read-only product data for polling clients. Every response carries a
+    # strong ETag built from catalog_version(), and a matching If-None-Match
+    # gets a bodyless 304 before any product is loaded.
+    def _catalog_not_modified() -> Tuple[str, Response | None]:
+        etag = f"catalog-{catalog_version()}"
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            return etag, resp
+        return etag, None
+
+    def _catalog_response(payload: Any, etag: str) -> Response:
+        resp = jsonify(payload)
+        resp.set_etag(etag)
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        return resp
+
+    def _product_json(p: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": p.get("id"),
+            "name": p.get("name"),
+            "sku": p.get("sku"),
+            "price": p.get("price"),
+            "stock": p.get("stock"),
+            "image_url": url_for("product_image", size="m", name=p["image"]) if p.get("image") else None,
+        }
+
+    @app.route("/api/productos")
+    def api_products():
+        if not require_login():
+            return jsonify({"error": "login required"}), 401
+        etag, not_modified = _catalog_not_modified()
+        if not_modified is not None:
+            return not_modified
+        return _catalog_response({"products": [_product_json(p) for p in iter_products()]}, etag)
+
+    @app.route("/api/productos/stock")
+    def api_products_stock():
+        if not require_login():
+            return jsonify({"error": "login required"}), 401
+        etag, not_modified = _catalog_not_modified()
+        if not_modified is not None:
+            return not_modified
+        return _catalog_response({p.get("id"): p.get("stock") for p in iter_products()}, etag)
+
+    @app.route("/api/productos/eventos")
+    def api_products_events():
+        """Product changes after ``since`` or the browser's Last-Event-ID.
+
+        A batch of JSON with ?format=json, otherwise server-sent events while
+        a stream slot is free (204 when none is).
+        """
+        if not require_login():
+            return jsonify({"error": "login required"}), 401
+        try:
+            last_id = int(request.headers.get("Last-Event-ID") or request.args.get("since", ""))
+        except ValueError:
+            last_id = latest_event_id()
+        if _wants_json():
+            events = events_after(last_id)
+            if events is None:
+                return jsonify({"reset": True, "last_id": latest_event_id(), "events": []})
+            return jsonify(
+                {
+                    "reset": False,
+                    "last_id": events[-1][0] if events else last_id,
+                    "events": [{"id": i, "kind": kind, "data": json.loads(data)} for i, kind, data in events],
+                }
+            )
+        # a 204 tells EventSource not to reconnect; the page polls instead
+        if not open_event_stream():
+            return Response(status=204)
+        resp = Response(event_stream(last_id), mimetype="text/event-stream")
+        resp.call_on_close(close_event_stream)
+        resp.cache_control.no_cache = True
+        # stop nginx-style proxies from buffering the stream
+        resp.headers["X-Accel-Buffering"] = "no"
         return resp
 
+    @app.route("/perfiles")
+    def profiles_list():
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+        return render_template(
+            "profiles.html", profiles=list_profiles(), sample_rate=PROFILE_SAMPLE_RATE, keep=PROFILE_KEEP
+        )
+
+    @app.route("/perfiles/<profile_id>")
+    def profile_detail(profile_id: str):
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+        profile = load_profile(profile_id)
+        if profile is None:
+            abort(404, description="Perfil no encontrado")
+        return render_template("profile.html", profile=profile)
+
+    @app.route("/perfiles/<profile_id>/descargar")
+    def profile_download(profile_id: str):
+        if not require_login() or not is_admin():
+            abort(403)
+        if load_profile(profile_id) is None:
+            abort(404, description="Perfil no encontrado")
+        return send_from_directory(
+            PROFILES_DIR, f"{profile_id}.pstats", as_attachment=True, mimetype="application/octet-stream"
+        )
+
+    @app.route("/metrics")
+    def metrics():
+        # admins, or requests made on this machine that did not come through
+        # a proxy (a reverse proxy would make every client look local)
+        local = request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+        if not local and not (require_login() and is_admin()):
+            abort(403)
+        return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.route("/api/productos/buscar")
+    def api_products_search():
+        if not require_login():
+            return jsonify({"error": "login required"}), 401
+        try:
+            limit = max(1, min(int(request.args.get("limit", SEARCH_LIMIT)), MAX_SEARCH_LIMIT))
+        except ValueError:
+            limit = SEARCH_LIMIT
+        return jsonify({"results": search_products(request.args.get("q", ""), limit)})
+
+    @app.route("/api/productos/<product_id>")
+    def api_product(product_id: str):
+        if not require_login():
+            return jsonify({"error": "login required"}), 401
+        etag, not_modified = _catalog_not_modified()
+        if not_modified is not None:
+            return not_modified
+        prod = get_product(product_id)
+        if prod is None:
+            return jsonify({"error": "not found"}), 404
+        return _catalog_response(_product_json(prod), etag)
+
     # --- Inventory (products) CRUD ---
     @app.route("/inventario")
     def products_list():
         # allow both admin and users to view products; render differs in template
         if not require_login():
             return redirect(url_for("login"))
-        products = get_products()
-        return render_template("products_list.html", products=products)
+        filters = {k: request.args.get(k, "").strip() for k in ("q", "price_min", "price_max")}
+        sort = request.args.get("sort", "")
+        # read before the query so cached rows are never newer than their key,
+        # and the change feed replays anything that happens after it
+        version = catalog_version()
+        events_since = latest_event_id()
+        products, next_cursor = query_products(filters, sort, request.args.get("cursor"), _page_size())
+        # buyers see what they can still put in a cart: stock minus live holds
+        held = {} if is_admin() else reserved_stock(p["id"] for p in products if _has_stock(p))
+        return render_template(
+            "products_list.html",
+            products=products,
+            held=held,
+            data_version=version,
+            events_since=events_since,
+            event_stream=event_stream_slots() > 0,
+            event_poll_ms=EVENT_CLIENT_POLL_MS,
+            filters={k: v for k, v in filters.items() if v},
+            sort=sort,
+            next_cursor=next_cursor,
+            paged=bool(request.args.get("cursor")),
+        )
 
     @app.route("/inventario/nuevo", methods=["GET", "POST"])
     def product_create():
@@ -633,31 +4070,21 @@ def create_app() -> Flask:
             stock = request.form.get("stock", "").strip()
             image_base64 = request.form.get("image_base64", "").strip()
 
-            errors = []
-            if not name:
-                errors.append("El nombre es obligatorio.")
-            try:
-                price_value = float(price) if price else 0.0
-                if price_value < 0:
-                    errors.append("El precio debe ser positivo.")
-            except ValueError:
-                errors.append("El precio debe ser numérico.")
-            try:
-                stock_value = int(stock) if stock else 0
-                if stock_value < 0:
-                    errors.append("El stock no puede ser negativo.")
-            except ValueError:
-                errors.append("El stock debe ser un número entero.")
+            price_value, stock_value, errors = validate_product_fields(name, price, stock)
+            image = ""
+            if image_base64:
+                try:
+                    image = store_image(image_base64)
+                except ValueError:
+                    errors.append("La imagen no es válida.")
 
             if errors:
                 for e in errors:
                     flash(e, "error")
                 return render_template("products_form.html", action="Crear", product={"name": name, "sku": sku, "price": price, "stock": stock})
 
-            new_prod = {"id": str(uuid4()), "name": name, "sku": sku, "price": price_value, "stock": stock_value, "image_base64": image_base64}
-            products = get_products()
-            products.append(new_prod)
-            persist_products(products)
+            new_prod = {"id": str(uuid4()), "name": name, "sku": sku, "price": price_value, "stock": stock_value, "image": image}
+            save_product(new_prod, event="create")
             flash("Producto agregado.", "success")
             return redirect(url_for("products_list"))
 
@@ -669,8 +4096,7 @@ def create_app() -> Flask:
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
 
-        products = get_products()
-        prod = next((p for p in products if p.get("id") == product_id), None)
+        prod = get_product(product_id)
         if not prod:
             abort(404, description="Producto no encontrado")
 
@@ -681,51 +4107,211 @@ def create_app() -> Flask:
             stock = request.form.get("stock", "").strip()
             image_base64 = request.form.get("image_base64", "").strip()
 
-            errors = []
-            if not name:
-                errors.append("El nombre es obligatorio.")
-            try:
-                price_value = float(price) if price else 0.0
-                if price_value < 0:
-                    errors.append("El precio debe ser positivo.")
-            except ValueError:
-                errors.append("El precio debe ser numérico.")
-            try:
-                stock_value = int(stock) if stock else 0
-                if stock_value < 0:
-                    errors.append("El stock no puede ser negativo.")
-            except ValueError:
-                errors.append("El stock debe ser un número entero.")
+            price_value, stock_value, errors = validate_product_fields(name, price, stock)
+            image = prod.get("image", "")
+            if image_base64:
+                try:
+                    image = store_image(image_base64)
+                except ValueError:
+                    errors.append("La imagen no es válida.")
 
             if errors:
                 for e in errors:
                     flash(e, "error")
                 return render_template("products_form.html", action="Editar", product={"id": product_id, "name": name, "sku": sku, "price": price, "stock": stock})
 
-            prod.update({"name": name, "sku": sku, "price": price_value, "stock": stock_value, "image_base64": image_base64})
-            persist_products(products)
+            prod.update({"name": name, "sku": sku, "price": price_value, "stock": stock_value, "image": image})
+            prod.pop("image_base64", None)
+            save_product(prod)
             flash("Producto actualizado.", "success")
             return redirect(url_for("products_list"))
 
         return render_template("products_form.html", action="Editar", product=prod)
 
+    @app.route("/importar", methods=["GET", "POST"])
+    def bulk_import():
+        """Carga masiva de productos o ventas desde un CSV o Excel."""
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+
+        kind = request.values.get("kind", "products")
+        if kind not in IMPORT_COLUMNS:
+            kind = "products"
+        if request.method == "GET":
+            return render_template("import.html", kind=kind, report=None)
+
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Selecciona un archivo CSV o Excel (.xlsx).", "error")
+            return render_template("import.html", kind=kind, report=None)
+        if not upload.filename.lower().endswith((".csv", ".txt", ".xlsx")):
+            flash("Formato no soportado: usa CSV o Excel (.xlsx).", "error")
+            return render_template("import.html", kind=kind, report=None)
+
+        rows = iter_import_rows(upload.stream, upload.filename)
+        report = new_import_report()
+        try:
+            with timed("shop_section_seconds", section=f"import_{kind}"):
+                if kind == "products":
+                    import_products(rows, report)
+                else:
+                    import_sales(rows, session.get("display_name"), report)
+        except ImportError:
+            flash("No se puede leer Excel: falta la librería 'openpyxl'. Instala con: pip install openpyxl", "error")
+            return render_template("import.html", kind=kind, report=None)
+        except (ValueError, UnicodeDecodeError, zipfile.BadZipFile) as exc:
+            message = str(exc) if isinstance(exc, ValueError) and str(exc) else "No se pudo leer el archivo."
+            if report["written"]:
+                # earlier batches were already saved and stay saved
+                message += f" Se guardaron las primeras {report['written']} filas válidas antes del error."
+            flash(message, "error")
+            return render_template("import.html", kind=kind, report=None)
+
+        if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+            return jsonify(report)
+        flash(
+            f"Importación terminada: {report['created']} creados, {report['updated']} actualizados, "
+            f"{len(report['errors'])} filas con errores.",
+            "error" if report["errors"] else "success",
+        )
+        return render_template("import.html", kind=kind, report=report)
+
     @app.route("/inventario/<product_id>/eliminar", methods=["POST"])
     def product_delete(product_id: str):
         if not require_login() or not is_admin():
             flash("Acceso denegado.", "error")
             return redirect(url_for("products_list"))
-        products = get_products()
-        new_products = [p for p in products if p.get("id") != product_id]
-        if len(new_products) == len(products):
+        if not delete_product(product_id):
             abort(404, description="Producto no encontrado")
-        persist_products(new_products)
         flash("Producto eliminado.", "info")
         return redirect(url_for("products_list"))
 
+    @app.route("/inventario/lote", methods=["POST"])
+    def products_bulk():
+        """Eliminar, cambiar el precio o ajustar el stock de varios productos con una sola escritura."""
+        if not require_login() or not is_admin():
+            flash("Acceso denegado.", "error")
+            return redirect(url_for("products_list"))
+
+        ids = [i for i in request.form.getlist("ids") if i]
+        action = request.form.get("action", "")
+        if not ids:
+            flash("Selecciona al menos un producto.", "error")
+        elif action == "delete":
+            flash(f"Productos eliminados: {delete_products(ids)}.", "info")
+        elif action == "price":
+            try:
+                price = float(request.form.get("price", "").strip())
+            except ValueError:
+                price = -1.0
+            if price < 0:
+                flash("El precio debe ser un número positivo.", "error")
+            else:
+                updated, _ = adjust_products(ids, price=price)
+                flash(f"Precio actualizado en {updated} productos.", "success")
+        elif action == "stock":
+            try:
+                delta = int(request.form.get("stock_delta", "").strip())
+            except ValueError:
+                delta = None
+            if delta is None:
+                flash("El ajuste de stock debe ser un número entero.", "error")
+            else:
+                updated, short = adjust_products(ids, stock_delta=delta)
+                if short:
+                    flash(f"El stock no puede quedar negativo: {', '.join(short)}.", "error")
+                else:
+                    flash(f"Stock ajustado en {updated} productos.", "success")
+        else:
+            flash("Acción no válida.", "error")
+        return redirect(url_for("products_list"))
+
+    @app.cli.command("compact-sales")
+    def compact_sales_command() -> None:
+        """Fold the sales journal into sales.json."""
+        folded = compact_sales_journal()
+        click.echo(f"{folded} registros compactados en {SALES_FILE.name}")
+
+    @app.cli.command("migrate-data")
+    def migrate_data_command() -> None:
+        """Upgrade stored sales to the current schema version."""
+        applied = migrate_data()
+        if applied:
+            click.echo(f"Migraciones aplicadas: {', '.join(str(v) for v in applied)}")
+        click.echo(f"Versión del esquema: {schema_version()}")
+
+    @app.cli.command("serve", with_appcontext=False)
+    @click.option("--host", default=SERVE_HOST, show_default=True)
+    @click.option("--port", default=SERVE_PORT, type=int, show_default=True)
+    @click.option("--workers", default=SERVE_WORKERS, type=int, show_default=True, help="Procesos.")
+    @click.option("--threads", default=SERVE_THREADS, type=int, show_default=True, help="Hilos por proceso.")
+    def serve_command(host: str, port: int, workers: int, threads: int) -> None:
+        """Run the app under a production server (see serve)."""
+        serve(app, host, port, workers, threads)
+
+    @app.cli.command("migrate-sqlite")
+    def migrate_sqlite_command() -> None:
+        """Copy the JSON data files into the SQLite database."""
+        counts = migrate_json_to_sqlite()
+        for table, count in counts.items():
+            click.echo(f"{table}: {count} registros")
+        click.echo(f"Base de datos: {DATABASE_FILE}")
+
+    app.add_template_global(asset_url)
+    app.add_template_global(cached_fragment)
+
+    @app.route("/assets/<path:filename>")
+    def asset(filename: str):
+        match = _ASSET_NAME.match(filename)
+        entry = _asset(match["stem"] + match["suffix"]) if match else None
+        if entry is None:
+            abort(404)
+        bodies = entry["bodies"]
+        encoding = next((e for e in ("br", "gzip") if e in bodies and request.accept_encodings[e]), "identity")
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        resp = Response(bodies[encoding], mimetype=mimetype)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.set_etag(f"{entry['digest']}-{encoding}")
+        if match["digest"] == entry["digest"]:
+            resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+        else:
+            # a stale URL from a page cached before the file changed: send the
+            # current content but do not pin it under the old name
+            resp.headers["Cache-Control"] = "no-cache"
+        return resp.make_conditional(request)
+
+    @app.route("/imagenes/<name>")
+    @app.route("/imagenes/<size>/<name>")
+    def product_image(name: str, size: str | None = None):
+        if not _IMAGE_NAME.match(name) or (size is not None and size not in IMAGE_SIZES):
+            abort(404)
+        directory = IMAGES_DIR
+        if size is not None and (IMAGES_DIR / size / name).exists():
+            directory = IMAGES_DIR / size
+        # the name is the content hash, so the URL never changes meaning
+        etag = f"{size or 'o'}-{name.split('.')[0]}"
+        resp = send_from_directory(directory, name, max_age=IMAGE_MAX_AGE, etag=etag)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
+
+    @app.cli.command("migrate-images")
+    def migrate_images_command() -> None:
+        """Move inline base64 product images into the image store."""
+        count = migrate_inline_images()
+        click.echo(f"{count} productos actualizados")
+
     return app
 
 
 if __name__ == "__main__":
     flask_app = create_app()
-    # Escucha en todas las interfaces (necesario para EC2)
-    flask_app.run(host="0.0.0.0", port=5000, debug=True)
+    if os.environ.get("SHOP_DEBUG") == "1":
+        # servidor de desarrollo, con recarga y depurador
+        flask_app.run(host=SERVE_HOST, port=SERVE_PORT, debug=True)
+    else:
+        # Escucha en todas las interfaces (necesario para EC2)
+        serve(flask_app)
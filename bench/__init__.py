@@ -0,0 +1,11 @@
+"""Benchmarks for the shop app.
+
+Generates synthetic users, products and sales, drives the routes through
+Flask's test client and writes latency percentiles, throughput and peak RSS
+per dataset size to a JSON file::
+
+    python -m bench --scales 1k,10k --output bench-results.json
+
+Each scale runs in its own process against its own data directory, so the
+peak RSS figures are per scale and the real data/ directory is never touched.
+"""
@@ -0,0 +1,156 @@
+"""Command line entry point: ``python -m bench --help``."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is reported as null
+    resource = None
+
+from . import datasets, scenarios
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def peak_rss_kb() -> int | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_worker(args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark one already generated data directory; runs inside its own process."""
+    sys.path.insert(0, str(REPO_DIR))
+    import app as shop
+
+    if args.prepare:
+        if shop.STORAGE_BACKEND == "sqlite":
+            shop.migrate_json_to_sqlite()
+        return {}
+
+    flask_app = shop.create_app()
+    ctx = scenarios.Context(flask_app, args.rows, seed=args.seed)
+    routes = {}
+    for name, share, step in scenarios.select(args.only):
+        count = max(1, round(args.requests * share))
+        samples: List[float] = []
+        statuses: Dict[int, int] = {}
+
+        def timed(call):
+            start = time.perf_counter()
+            response = call()
+            # streamed bodies (CSV report) are only produced when read
+            response.get_data()
+            samples.append(time.perf_counter() - start)
+            return response
+
+        started = time.perf_counter()
+        for _ in range(count):
+            status = step(ctx, timed)
+            statuses[status] = statuses.get(status, 0) + 1
+        routes[name] = scenarios.stats(samples, time.perf_counter() - started, statuses)
+    return {"routes": routes, "peak_rss_kb": peak_rss_kb(), "cache_stats": dict(shop.cache_stats)}
+
+
+def run_scale(label: str, args: argparse.Namespace) -> Dict[str, Any]:
+    sys.path.insert(0, str(REPO_DIR))
+    import app as shop
+
+    rows = datasets.parse_scale(label)
+    with tempfile.TemporaryDirectory(prefix="shop-bench-") as tmp:
+        data_dir = Path(tmp) / "data"
+        started = time.perf_counter()
+        datasets.generate(data_dir, rows, shop.SCHEMA_VERSION, seed=args.seed)
+        generated = time.perf_counter() - started
+
+        env = dict(os.environ, SHOP_DATA_DIR=str(data_dir))
+        command = [sys.executable, "-m", "bench", "--worker", "--rows", str(rows), "--seed", str(args.seed)]
+        command += ["--requests", str(args.requests)]
+        if args.only:
+            command += ["--only", ",".join(args.only)]
+        started = time.perf_counter()
+        subprocess.run(command + ["--prepare"], cwd=REPO_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+        prepared = time.perf_counter() - started
+        out = subprocess.run(command, cwd=REPO_DIR, env=env, check=True, capture_output=True, text=True)
+        result = json.loads(out.stdout)
+    result.update(
+        {"scale": label, "rows": rows, "generate_s": round(generated, 3), "prepare_s": round(prepared, 3)}
+    )
+    return result
+
+
+def _summary(result: Dict[str, Any]) -> str:
+    lines = [f"{result['scale']} ({result['rows']} rows) peak RSS {result['peak_rss_kb']} KB"]
+    for name, r in result["routes"].items():
+        lines.append(
+            f"  {name:<22} p50 {r['p50_ms']:>9.2f} ms  p95 {r['p95_ms']:>9.2f} ms  "
+            f"p99 {r['p99_ms']:>9.2f} ms  {r['throughput_rps']:>8.1f} req/s  errors {r['errors']}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__)
+    parser.add_argument("--scales", default="1k,10k", help="comma separated: " + ", ".join(datasets.SCALES) + " or a row count")
+    parser.add_argument("--requests", type=int, default=50, help="requests per route (reports run a tenth of that)")
+    parser.add_argument("--only", type=lambda s: [n for n in s.split(",") if n], help="comma separated scenarios: " + ", ".join(scenarios.names()))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench-results.json", help="where to write the JSON results")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--prepare", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        json.dump(run_worker(args), sys.stdout)
+        return
+
+    scenarios.select(args.only)
+    results = []
+    for label in [s for s in args.scales.split(",") if s.strip()]:
+        result = run_scale(label.strip(), args)
+        print(_summary(result), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": os.environ.get("SHOP_STORAGE", "json"),
+            "sales_storage": os.environ.get("SHOP_SALES_STORAGE", "json"),
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Synthetic data files in the layout app.py reads from data/."""
+
+from __future__ import annotations
+
+import json
+import random
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterable
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# every generated user shares this password; "admin" keeps the app's default
+USER_PASSWORD = "bench"
+ADMIN_PASSWORD = "admin123"
+# high enough that the checkout scenario never runs out of stock
+PRODUCT_STOCK = 1_000_000
+# sales are spread, in id order, over the two years before this date
+SALES_END = datetime(2025, 1, 1)
+SALES_SPAN = timedelta(days=730)
+
+WORDS = [
+    "Lámpara", "Mesa", "Silla", "Taza", "Cuaderno", "Mochila", "Camisa", "Zapato",
+    "Reloj", "Botella", "Cable", "Teclado", "Ratón", "Monitor", "Libro", "Gorra",
+]
+
+
+def parse_scale(text: str) -> int:
+    key = text.strip().lower()
+    if key in SCALES:
+        return SCALES[key]
+    return int(key)
+
+
+def product_id(i: int) -> str:
+    return f"bench-p-{i:07d}"
+
+
+def sale_id(i: int) -> str:
+    return f"bench-s-{i:07d}"
+
+
+def user_count(rows: int) -> int:
+    return max(10, rows // 100)
+
+
+def _write_list(path: Path, head: Dict[str, Any], key: str, records: Iterable[Dict[str, Any]]) -> None:
+    # written record by record so a million sales never sit in memory at once
+    with path.open("w", encoding="utf-8") as f:
+        f.write(json.dumps(head, ensure_ascii=False)[:-1])
+        f.write(f'{", " if head else ""}"{key}": [')
+        for n, record in enumerate(records):
+            if n:
+                f.write(",")
+            f.write(json.dumps(record, ensure_ascii=False))
+        f.write("]}")
+
+
+def generate(data_dir: Path, rows: int, schema_version: int, seed: int = 0) -> None:
+    """Write users.json, products.json and sales.json with ``rows`` products and sales."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    users = user_count(rows)
+
+    def user_records():
+        yield {"username": "admin", "password": ADMIN_PASSWORD, "name": "Administrador"}
+        for i in range(users):
+            yield {
+                "username": f"user{i}",
+                "password": USER_PASSWORD,
+                "name": f"Cliente {i}",
+                "email": f"user{i}@example.com",
+                "phone": f"555-{i:06d}",
+            }
+
+    names = [f"{rng.choice(WORDS)} {rng.choice(WORDS).lower()} {i}" for i in range(rows)]
+    prices = [round(rng.uniform(1, 500), 2) for _ in range(rows)]
+
+    def product_records():
+        for i in range(rows):
+            yield {
+                "id": product_id(i),
+                "name": names[i],
+                "sku": f"SKU-{i:07d}",
+                "price": prices[i],
+                "stock": PRODUCT_STOCK,
+                "image": "",
+                "seq": i + 1,
+            }
+
+    step = SALES_SPAN / rows
+    start = SALES_END - SALES_SPAN
+
+    def sale_records():
+        for i in range(rows):
+            p = rng.randrange(rows)
+            u = rng.randrange(users)
+            yield {
+                "id": sale_id(i),
+                "product": names[p],
+                "product_id": product_id(p),
+                "quantity": rng.randint(1, 5),
+                "price": prices[p],
+                "customer": {"name": f"Cliente {u}", "email": f"user{u}@example.com", "phone": f"555-{u:06d}"},
+                "seller": f"Cliente {u}",
+                "created_at": (start + step * i).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "seq": i + 1,
+            }
+
+    _write_list(data_dir / "users.json", {}, "users", user_records())
+    _write_list(data_dir / "products.json", {"version": 1}, "products", product_records())
+    _write_list(data_dir / "sales.json", {"schema_version": schema_version}, "sales", sale_records())
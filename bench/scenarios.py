@@ -0,0 +1,181 @@
+"""One timed request per call for each route under test."""
+
+from __future__ import annotations
+
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from . import datasets
+
+# (name, share of --requests, step); a step performs any untimed setup, then
+# calls ``timed`` exactly once around the request being measured and returns
+# its status code
+Step = Callable[["Context", Callable[[Callable[[], Any]], Any]], int]
+# records per request in the bulk scenarios
+BULK_SIZE = 10
+
+
+class Context:
+    """Logged-in clients plus the ids the scenarios pick from."""
+
+    def __init__(self, app, rows: int, seed: int = 0) -> None:
+        self.app = app
+        self.rows = rows
+        self.rng = random.Random(seed)
+        self.admin = self.login("admin", datasets.ADMIN_PASSWORD)
+        self.user = self.login("user0", datasets.USER_PASSWORD)
+        # deletes take ids from the top so they never hit a record that an
+        # edit or a cart is about to use
+        self.next_sale_delete = rows - 1
+        self.next_product_delete = rows - 1
+
+    def login(self, username: str, password: str):
+        client = self.app.test_client()
+        client.post("/login", data={"username": username, "password": password})
+        return client
+
+    def any_product(self) -> str:
+        return datasets.product_id(self.rng.randrange(self.rows // 2))
+
+    def any_sale(self) -> str:
+        return datasets.sale_id(self.rng.randrange(self.rows // 2))
+
+
+def _get(who: str, url: Callable[["Context"], str]) -> Step:
+    def step(ctx: Context, timed) -> int:
+        client = getattr(ctx, who)
+        return timed(lambda: client.get(url(ctx))).status_code
+
+    return step
+
+
+def _login(ctx: Context, timed) -> int:
+    client = ctx.app.test_client()
+    data = {"username": f"user{ctx.rng.randrange(datasets.user_count(ctx.rows))}", "password": datasets.USER_PASSWORD}
+    return timed(lambda: client.post("/login", data=data)).status_code
+
+
+def _cart_add(ctx: Context, timed) -> int:
+    data = {"product_id": ctx.any_product(), "quantity": "1"}
+    return timed(lambda: ctx.user.post("/carrito/agregar", data=data)).status_code
+
+
+def _cart_checkout(ctx: Context, timed) -> int:
+    ctx.user.post("/carrito/agregar", data={"product_id": ctx.any_product(), "quantity": "1"})
+    return timed(lambda: ctx.user.post("/carrito/checkout")).status_code
+
+
+def _report_xlsx(ctx: Context, timed) -> int:
+    # submit, poll until the background job is done, then download; once the
+    # data is unchanged the first request already returns the stored file
+    def cycle():
+        job = ctx.admin.get("/ventas/reporte?format=json").get_json()
+        while job["status"] not in ("done", "error"):
+            time.sleep(0.01)
+            job = ctx.admin.get(job["status_url"]).get_json()
+        if job["status"] == "error":
+            return ctx.admin.get(job["status_url"])
+        return ctx.admin.get(job["download_url"])
+
+    return timed(cycle).status_code
+
+
+def _sale_edit(ctx: Context, timed) -> int:
+    data = {
+        "product": "Venta editada",
+        "product_id": ctx.any_product(),
+        "quantity": str(ctx.rng.randint(1, 5)),
+        "price": "",
+        "customer_name": "Cliente editado",
+        "customer_email": "editado@example.com",
+        "customer_phone": "555-000000",
+    }
+    url = f"/ventas/{ctx.any_sale()}/editar"
+    return timed(lambda: ctx.admin.post(url, data=data)).status_code
+
+
+def _sale_delete(ctx: Context, timed) -> int:
+    url = f"/ventas/{datasets.sale_id(ctx.next_sale_delete)}/eliminar"
+    ctx.next_sale_delete -= 1
+    return timed(lambda: ctx.admin.post(url)).status_code
+
+
+def _sales_bulk_delete(ctx: Context, timed) -> int:
+    ids = [datasets.sale_id(ctx.next_sale_delete - i) for i in range(BULK_SIZE)]
+    ctx.next_sale_delete -= BULK_SIZE
+    return timed(lambda: ctx.admin.post("/ventas/lote", data={"action": "delete", "ids": ids})).status_code
+
+
+def _product_edit(ctx: Context, timed) -> int:
+    data = {"name": f"Producto editado {ctx.rng.randrange(1000)}", "sku": "", "price": "9.99", "stock": str(datasets.PRODUCT_STOCK)}
+    url = f"/inventario/{ctx.any_product()}/editar"
+    return timed(lambda: ctx.admin.post(url, data=data)).status_code
+
+
+def _product_delete(ctx: Context, timed) -> int:
+    url = f"/inventario/{datasets.product_id(ctx.next_product_delete)}/eliminar"
+    ctx.next_product_delete -= 1
+    return timed(lambda: ctx.admin.post(url)).status_code
+
+
+SCENARIOS: List[Tuple[str, float, Step]] = [
+    ("login", 1, _login),
+    ("inventario_admin", 1, _get("admin", lambda ctx: "/inventario")),
+    ("inventario_tienda", 1, _get("user", lambda ctx: "/inventario")),
+    ("inventario_filtro", 1, _get("admin", lambda ctx: "/inventario?q=mesa&price_max=100")),
+    ("producto_buscar", 1, _get("admin", lambda ctx: "/api/productos/buscar?q=lam")),
+    ("api_productos", 0.1, _get("admin", lambda ctx: "/api/productos")),
+    ("cart_add", 1, _cart_add),
+    ("cart_view", 1, _get("user", lambda ctx: "/carrito")),
+    ("cart_checkout", 1, _cart_checkout),
+    ("ventas", 1, _get("admin", lambda ctx: "/ventas")),
+    ("ventas_filtro", 1, _get("admin", lambda ctx: "/ventas?customer=cliente 1&sort=-price")),
+    ("ventas_fecha", 1, _get("admin", lambda ctx: "/ventas?date_from=2024-06-01&date_to=2024-06-30")),
+    ("ventas_resumen", 1, _get("admin", lambda ctx: "/ventas/resumen")),
+    ("ventas_resumen_mes", 1, _get("admin", lambda ctx: "/ventas/resumen?date_from=2024-06-01&date_to=2024-06-30")),
+    ("ventas_reporte_xlsx", 0.1, _report_xlsx),
+    ("ventas_reporte_csv", 0.1, _get("admin", lambda ctx: "/ventas/reporte?format=csv")),
+    ("venta_editar", 1, _sale_edit),
+    ("venta_eliminar", 1, _sale_delete),
+    ("ventas_lote_eliminar", 0.1, _sales_bulk_delete),
+    ("producto_editar", 1, _product_edit),
+    ("producto_eliminar", 1, _product_delete),
+]
+
+
+def names() -> List[str]:
+    return [name for name, _, _ in SCENARIOS]
+
+
+def select(wanted: List[str] | None) -> List[Tuple[str, float, Step]]:
+    if not wanted:
+        return list(SCENARIOS)
+    unknown = set(wanted) - set(names())
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return [s for s in SCENARIOS if s[0] in wanted]
+
+
+def stats(samples: List[float], elapsed: float, statuses: Dict[int, int]) -> Dict[str, Any]:
+    """Latency percentiles (nearest rank, in ms) and throughput for one scenario."""
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        if not ordered:
+            return 0.0
+        rank = max(1, -(-len(ordered) * p // 100))
+        return round(ordered[int(rank) - 1] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "errors": sum(n for status, n in statuses.items() if status >= 500),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "first_ms": round(samples[0] * 1000, 3) if samples else 0.0,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+    }
@@ -0,0 +1,159 @@
+"""Keyset pagination of /inventario and /ventas (query_products, query_sales)."""
+
+import pytest
+
+import app as shop
+
+BACKENDS = [("json", "json"), ("json", "journal"), ("json", "monthly"), ("sqlite", "json")]
+
+
+@pytest.fixture(params=BACKENDS, ids=lambda b: b[0] if b[0] == "sqlite" else b[1])
+def store(request, tmp_path, monkeypatch):
+    storage, sales_storage = request.param
+    for name, file_name in [
+        ("DATA_DIR", ""),
+        ("USERS_FILE", "users.json"),
+        ("SALES_FILE", "sales.json"),
+        ("PRODUCTS_FILE", "products.json"),
+        ("SALES_JOURNAL_FILE", "sales.journal.jsonl"),
+        ("SALES_SHARDS_DIR", "sales"),
+        ("DATABASE_FILE", "shop.db"),
+        ("CARTS_FILE", "carts.db"),
+        ("EVENTS_FILE", "events.db"),
+        ("METRICS_FILE", "metrics.db"),
+    ]:
+        monkeypatch.setattr(shop, name, tmp_path / file_name)
+    monkeypatch.setattr(shop, "STORAGE_BACKEND", storage)
+    monkeypatch.setattr(shop, "SALES_STORAGE", sales_storage)
+    shop._listing_indexes.clear()
+    shop._journal_state["stamp"] = None
+    yield shop
+    shop.close_connections()
+    shop._listing_indexes.clear()
+
+
+def _products(n):
+    return [
+        {"id": f"p{i:02d}", "name": f"Producto {i % 7}", "sku": f"S{i:02d}", "price": float(i % 5), "stock": i}
+        for i in range(n)
+    ]
+
+
+def _sales(n):
+    # spread over three months so the monthly mode has several shards
+    return [
+        {
+            "id": f"s{i:02d}",
+            "product": f"Producto {i % 4}",
+            "product_id": "",
+            "quantity": 1,
+            "price": float(i % 3),
+            "customer": {"name": "C", "email": "", "phone": ""},
+            "seller": "V",
+            "created_at": f"2024-0{1 + i % 3}-10T10:00:{i:02d}Z",
+        }
+        for i in range(n)
+    ]
+
+
+def _walk(query, sort, limit=4, between=None):
+    """Every page from the top; ``between(page_number)`` runs before each later page."""
+    rows, cursor, number = [], None, 0
+    while True:
+        page, cursor = query({}, sort, cursor, limit)
+        rows.extend(r["id"] for r in page)
+        number += 1
+        if cursor is None:
+            return rows
+        if between is not None:
+            between(number)
+
+
+@pytest.mark.parametrize("sort", ["", "name", "price", "-price", "-stock"])
+def test_product_pages_cover_everything_once(store, sort):
+    store.save_products(_products(17))
+    expected = [r["id"] for r in store.query_products({}, sort, None, 100)[0]]
+    assert len(expected) == 17
+    assert _walk(store.query_products, sort) == expected
+
+
+@pytest.mark.parametrize("sort", ["", "price", "-created_at"])
+def test_sale_pages_cover_everything_once(store, sort):
+    store.add_sales(_sales(13))
+    expected = [r["id"] for r in store.query_sales({}, sort, None, 100)[0]]
+    assert sorted(expected) == [f"s{i:02d}" for i in range(13)]
+    assert _walk(store.query_sales, sort) == expected
+
+
+def test_default_order_is_insertion_order(store):
+    store.save_products(_products(5))
+    store.save_products([{"id": "late", "name": "Nuevo", "sku": "", "price": 1.0, "stock": 1}])
+    # an update keeps the product where it was
+    store.save_products([dict(store.get_product("p01"), name="Editado")])
+    ids = [r["id"] for r in store.query_products({}, "", None, 100)[0]]
+    assert ids == ["p00", "p01", "p02", "p03", "p04", "late"]
+
+
+@pytest.mark.parametrize("sort", ["", "price", "-price"])
+def test_deleting_the_cursor_row_does_not_end_the_listing(store, sort):
+    store.save_products(_products(12))
+    first, cursor = store.query_products({}, sort, None, 4)
+    expected = [r["id"] for r in store.query_products({}, sort, None, 100)[0]][4:]
+    # the last row shown, which the cursor points at, and one row before it
+    store.delete_products([first[-1]["id"], first[0]["id"]])
+    rest, seen = [], cursor
+    while seen is not None:
+        page, seen = store.query_products({}, sort, seen, 4)
+        rest.extend(r["id"] for r in page)
+    assert rest == expected
+
+
+def test_deleting_sales_between_pages(store):
+    store.add_sales(_sales(10))
+    deleted = []
+
+    def delete_last_shown(number):
+        shown = store.query_sales({}, "", None, 4 * number)[0]
+        deleted.append(shown[-1]["id"])
+        store.delete_sales([shown[-1]["id"]])
+
+    rows = _walk(store.query_sales, "", between=delete_last_shown)
+    assert sorted(rows + [d for d in deleted if d not in rows]) == [f"s{i:02d}" for i in range(10)]
+    assert len(rows) == len(set(rows))
+
+
+def test_filters_apply_across_pages(store):
+    store.add_sales(_sales(12))
+    page, cursor = store.query_sales({"date_from": "2024-02-01", "date_to": "2024-02-29"}, "", None, 2)
+    rows = [r["id"] for r in page]
+    while cursor:
+        page, cursor = store.query_sales({"date_from": "2024-02-01", "date_to": "2024-02-29"}, "", cursor, 2)
+        rows.extend(r["id"] for r in page)
+    assert rows == ["s01", "s04", "s07", "s10"]
+
+
+@pytest.mark.parametrize(
+    "sort, cursor",
+    [
+        ("price", "garbage"),
+        ("", shop.encode_cursor("", None, "p03")),
+        ("price", shop.encode_cursor("price", "x", "p03")),
+        ("price", shop.encode_cursor("name", "a", "p03")),
+    ],
+)
+def test_bad_cursors_start_from_the_top(store, sort, cursor):
+    store.save_products(_products(6))
+    top = store.query_products({}, sort, None, 3)
+    assert store.query_products({}, sort, cursor, 3) == top
+
+
+def test_sqlite_sorts_use_an_index(store):
+    if store.STORAGE_BACKEND != "sqlite":
+        pytest.skip("SQLite only")
+    store.save_products(_products(3))
+    expr = store._db_sort_expr("price", True)
+    plan = store._db().execute(
+        f"EXPLAIN QUERY PLAN SELECT doc FROM products WHERE ({expr}, id) < (?, ?) ORDER BY {expr} DESC, id DESC LIMIT 5",
+        (1.0, "p01"),
+    ).fetchall()
+    assert any("products_by_price" in row[-1] for row in plan), plan